@@ -0,0 +1,188 @@
+"""
+Compiler benchmark on synthetic programs.
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from emitter import Emitter
+from generator import generate
+from lexer import Tag, TokenBuffer
+from myparser import Parser, make_lexer
+from optimizer import count_nodes
+from tree import walk
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def name(prefix, num):
+    """Spells num in letters; identifiers may not contain digits."""
+
+    s = ''
+    while True:
+        s = LETTERS[num % 26] + s
+        num //= 26
+        if not num:
+            return prefix + s
+
+
+class ProgramGenerator:
+    """Builds valid programs of a requested shape.
+
+    defs       number of functions besides main
+    stmts      assignments per function, before the return
+    depth      binary operators per expression
+    ternary    nested `a if c else ...` levels in each return
+    fanout     calls to earlier functions per function
+    """
+
+    def __init__(self, defs=100, stmts=10, depth=4, ternary=2, fanout=2, seed=0):
+        self.defs = defs
+        self.stmts = stmts
+        self.depth = depth
+        self.ternary = ternary
+        self.fanout = fanout
+        self.rand = random.Random(seed)
+        self.functions = []
+
+    def atom(self, names):
+        if names and self.rand.random() < 0.6:
+            return self.rand.choice(names)
+        return str(self.rand.randint(0, 1000))
+
+    def expression(self, names):
+        parts = [self.atom(names)]
+        for _ in range(self.depth):
+            parts.append(self.rand.choice('+-*%'))
+            parts.append(self.atom(names))
+        return ' '.join(parts)
+
+    def call(self, names):
+        callee, arity = self.rand.choice(self.functions)
+        args = ', '.join(self.atom(names) for _ in range(arity))
+        return f'{callee}({args})'
+
+    def function(self, func_name, params):
+        names = list(params)
+        lines = [f'def {func_name}({", ".join(params)}):']
+        calls = set(self.rand.sample(range(self.stmts), min(self.fanout, self.stmts))) if self.functions else ()
+        for num in range(self.stmts):
+            target = name('v', num)
+            value = self.expression(names)
+            if num in calls:
+                value = f'{self.call(names)} + {value}'
+            lines.append(f'    {target} = {value}')
+            names.append(target)
+        ret = self.expression(names)
+        for _ in range(self.ternary):
+            ret = f'{self.expression(names)} if {self.atom(names)} else {ret}'
+        lines.append(f'    return {ret}')
+        return '\n'.join(lines) + '\n\n'
+
+    def program(self):
+        chunks = []
+        for num in range(self.defs):
+            func_name = name('f', num)
+            params = [name('p', i) for i in range(self.rand.randint(0, 3))]
+            chunks.append(self.function(func_name, params))
+            self.functions.append((func_name, len(params)))
+        chunks.append(self.function('main', []))
+        return ''.join(chunks)
+
+
+def best_of(repeat, fn):
+    """Runs fn repeat times, returns (shortest time, last result)."""
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def lex_all(code):
+    lx = make_lexer(code)
+    count = 0
+    while next(lx).tag != Tag.EOF:
+        count += 1
+    return count + 1
+
+
+def emit(tree):
+    out = Emitter()
+    walk(tree.visit(out))
+    return out.getvalue()
+
+
+def run(code, repeat=3):
+    """Times each compiler phase on code, returns the results."""
+
+    lex_time, tokens = best_of(repeat, lambda: lex_all(code))
+    packed = TokenBuffer(make_lexer(code))
+
+    def parse_packed():
+        packed.index = 0
+        return Parser(packed).module()
+
+    parse_time, tree = best_of(repeat, parse_packed)
+    nodes = count_nodes(tree)
+    visit_time, body = best_of(repeat, lambda: emit(tree))
+    generate_time, asm = best_of(repeat, lambda: generate(tree))
+    return {
+        'source_bytes': len(code),
+        'tokens': tokens,
+        'nodes': nodes,
+        'output_bytes': len(asm),
+        'lexer': {'seconds': lex_time, 'tokens_per_sec': tokens / lex_time},
+        'parser': {'seconds': parse_time, 'nodes_per_sec': nodes / parse_time},
+        'visit': {'seconds': visit_time, 'bytes_per_sec': len(body) / visit_time},
+        'generate': {'seconds': generate_time, 'bytes_per_sec': len(asm) / generate_time},
+    }
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Times the compiler phases on a generated program.')
+    ap.add_argument('--defs', type=int, default=100)
+    ap.add_argument('--stmts', type=int, default=10)
+    ap.add_argument('--depth', type=int, default=4)
+    ap.add_argument('--ternary', type=int, default=2)
+    ap.add_argument('--fanout', type=int, default=2)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('-o', '--output', default='bench.json', help='JSON results file')
+    args = ap.parse_args(argv)
+
+    params = dict(defs=args.defs, stmts=args.stmts, depth=args.depth,
+                  ternary=args.ternary, fanout=args.fanout, seed=args.seed)
+    code = ProgramGenerator(**params).program()
+    report = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'params': params,
+        'repeat': args.repeat,
+        'results': run(code, args.repeat),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for phase in ('lexer', 'parser', 'visit', 'generate'):
+        print(f'{phase:9} {report["results"][phase]["seconds"]:.4f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""
+Persistent per-function code cache.
+"""
+
+import hashlib
+import os
+import threading
+
+import emitter
+import generator
+import ir
+import isel
+import lexer
+import myparser
+import optimizer
+import peephole
+import tree
+from tree import CallFunc, FunctionDef
+
+
+def fingerprint():
+    """Hashes the compiler's own sources, from the lexer to the emitter, so
+    edits invalidate the cache."""
+
+    digest = hashlib.sha256()
+    for module in (lexer, myparser, tree, optimizer, ir, isel, peephole, emitter, generator):
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def dump(node):
+    """Returns a canonical text form of an AST."""
+
+    parts = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, tuple):
+            parts.append(node[0])  # punctuation queued below
+        elif isinstance(node, list):
+            stack.append((']',))
+            for i in reversed(range(len(node))):
+                stack.append(node[i])
+                if i:
+                    stack.append((',',))
+            stack.append(('[',))
+        elif not hasattr(node, '__slots__'):
+            parts.append(repr(node))
+        else:
+            parts.append(type(node).__name__ + '(')
+            stack.append((')',))
+            fields = [name for name in node.__slots__ if name != 'source']
+            for i in reversed(range(len(fields))):
+                stack.append(getattr(node, fields[i]))
+                if i:
+                    stack.append((',',))
+    return ''.join(parts)
+
+
+def calls(node):
+    """Returns the (name, arity) signatures of the functions node calls."""
+
+    found = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif hasattr(node, '__slots__'):
+            if isinstance(node, CallFunc):
+                found.add((node.name, len(node.args)))
+            stack.extend(getattr(node, name) for name in node.__slots__)
+    return sorted(found)
+
+
+class FunctionCache:
+    """Maps function keys to generated code, one file per entry in path.
+
+    The key covers the function's source text (or its AST once a pass has
+    rewritten it), the signatures of the functions it calls, the code
+    generation options and the code generator itself. When the entries
+    exceed max_bytes the least recently used ones are deleted, down to
+    three quarters of the limit so that eviction does not run on every put.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()  # counters and size, for threaded callers
+        self.version = fingerprint()
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def entries(self):
+        """Returns (mtime, size, path) of each entry, skipping the temporary
+        files put() is writing, possibly in another process, and entries
+        deleted while scanning."""
+
+        found = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.tmp') or not entry.is_file():
+                continue
+            try:
+                info = entry.stat()
+            except FileNotFoundError:
+                continue
+            found.append((info.st_mtime, info.st_size, entry.path))
+        return found
+
+    def key(self, func: FunctionDef, options=''):
+        """Returns the cache key of a FunctionDef."""
+
+        digest = hashlib.sha256()
+        digest.update(self.version.encode())
+        digest.update(options.encode())
+        digest.update(repr(calls(func.body)).encode())
+        if func.source is not None:
+            digest.update(func.source.encode())
+        else:
+            digest.update(dump(func).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns cached code, None on a miss."""
+
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, encoding='utf-8', newline='') as f:
+                code = f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)  # mtime orders entries for eviction
+        except OSError:
+            pass  # evicted by another process since
+        with self.lock:
+            self.hits += 1
+        return code
+
+    def put(self, key, code):
+        """Stores code under key and evicts old entries beyond max_bytes."""
+
+        path = os.path.join(self.path, key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w', encoding='utf-8', newline='') as f:
+            f.write(code)
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, path)
+        with self.lock:
+            self.size += len(code.encode('utf-8')) - replaced
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits again."""
+
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'bytes': self.size}
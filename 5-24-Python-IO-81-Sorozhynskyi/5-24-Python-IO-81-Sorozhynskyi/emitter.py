@@ -0,0 +1,70 @@
+"""
+Assembly emitter.
+"""
+
+import sys
+from collections import namedtuple
+
+from instrument import emitting_node
+
+# switches of the AST code generator; all off gives the stack machine
+CodegenOptions = namedtuple('CodegenOptions', 'regalloc strength hot_locals branchless fastcall',
+                            defaults=(False,) * 5)
+
+
+class Emitter:
+    """Accumulates generated code.
+
+    Every piece of text is appended exactly once: either to a list of chunks
+    that is joined at the end, or straight to a file object given as stream.
+    The CodegenOptions in codegen are also kept as attributes of their own
+    name for the visit methods. With regalloc set, binary expressions are evaluated in registers
+    instead of on the stack. With strength set, multiplication and modulo
+    by constants avoid mul and div. With hot_locals set, the most read
+    locals of each function are kept in registers. With branchless set,
+    not and cheap ternaries use setcc and cmov instead of jumps. With
+    fastcall set, functions with few arguments take them in registers.
+    """
+
+    def __init__(self, stream=None, codegen=CodegenOptions()):
+        self.stream = stream
+        self.codegen = codegen
+        self.regalloc, self.strength, self.hot_locals, self.branchless, self.fastcall = codegen
+        self.frame = None  # Frame of the function being generated
+        self.chunks = []
+        self.write = stream.write if stream is not None else self.chunks.append
+
+    def emit(self, *instructions):
+        """Writes each instruction on its own line."""
+
+        for ins in instructions:
+            self.write(ins + '\n')
+
+    def getvalue(self):
+        """Returns everything written so far (empty when streaming)."""
+
+        return ''.join(self.chunks)
+
+
+class InstrumentedEmitter(Emitter):
+    """Emitter that records instructions per AST node class in a Stats.
+
+    With count_bytes set the text written also goes to stats.bytes.
+    """
+
+    def __init__(self, stats, stream=None, codegen=CodegenOptions(), count_bytes=True):
+        super().__init__(stream, codegen)
+        self.stats = stats
+        self.count_bytes = count_bytes
+        self.sink = self.write
+        self.write = self.counting_write
+
+    def counting_write(self, text):
+        lines = sum(1 for line in text.split('\n') if line.strip())
+        if lines:
+            node = emitting_node(sys._getframe(1), self)
+            if node is not None:
+                self.stats.instructions[node] += lines
+        if self.count_bytes:
+            self.stats.bytes += len(text)
+        self.sink(text)
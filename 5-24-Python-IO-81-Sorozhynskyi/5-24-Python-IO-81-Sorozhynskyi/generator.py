@@ -2,7 +2,37 @@
 Code generator.
 """
 
-from tree import FunctionDef
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import repeat
+
+from emitter import CodegenOptions, Emitter, InstrumentedEmitter
+from ir import PassManager, lower
+from isel import select
+from peephole import Peephole
+from tree import FunctionDef, walk
+
+
+HEADER = (
+    """.386
+.model flat, stdcall
+option casemap:none
+include C://masm32/include/masm32rt.inc 
+main PROTO
+.data
+.code
+""")
+
+ENTRY = ("""
+start:
+    invoke main
+    fn MessageBox,0,str$(eax), "Lab5" ,MB_OK
+    invoke ExitProcess, 0
+    """)
+END = ("""
+
+END start""")
+HEADER_P6 = HEADER.replace('.386', '.686', 1)  # cmov is a Pentium Pro instruction
 
 
 class NoEntryError(Exception):
@@ -21,32 +51,156 @@ def has_main(tree):
     return False
 
 
-def generate(tree):
-    """Generates MASM32 code from AST."""
+def generate_function(node, codegen=CodegenOptions(), peephole=None, stats=None):
+    """Generates the code of one FunctionDef."""
+
+    if stats is None:
+        func = Emitter(codegen=codegen)
+    else:
+        func = InstrumentedEmitter(stats, codegen=codegen, count_bytes=False)
+    walk(node.visit(func))
+    if peephole is None:
+        return func.getvalue()
+    return peephole.run_text(func.getvalue())
+
+
+def generate_functions(nodes, codegen=CodegenOptions(), peephole=None):
+    """Generates a batch of FunctionDefs in a pool worker.
+
+    Returns their code and the hits of a fresh copy of peephole.
+    """
+
+    if peephole is not None:
+        peephole = Peephole(peephole.rules)
+    code = [generate_function(node, codegen, peephole) for node in nodes]
+    return code, peephole and peephole.hits
+
+
+def generate_code(nodes, codegen=CodegenOptions(), peephole=None, cache=None, workers=1,
+                  stats=None):
+    """Yields the code of each FunctionDef in source order.
+
+    Functions come from cache when it has them, the rest are generated in
+    this process or, with more than one worker, in a process pool. Stats
+    only sees the instructions of functions generated in this process.
+    """
+
+    options = f'{codegen} peephole={peephole and [r.__name__ for r in peephole.rules]}'
+    keys = [cache.key(node, options) if cache else None for node in nodes]
+    if workers == 1:
+        for node, key in zip(nodes, keys):
+            func = cache.get(key) if cache else None
+            if func is None:
+                func = generate_function(node, codegen, peephole, stats)
+                if cache:
+                    cache.put(key, func)
+            yield func
+        return
+
+    cached = [cache.get(key) if cache else None for key in keys]
+    missing = [node for node, func in zip(nodes, cached) if func is None]
+    size = max(1, len(missing) // (workers * 4))
+    chunks = [missing[i:i + size] for i in range(0, len(missing), size)]
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(generate_functions, chunks, repeat(codegen), repeat(peephole))
+        fresh = iter(())
+        for key, func in zip(keys, cached):
+            if func is None:
+                func = next(fresh, None)
+                if func is None:
+                    batch, hits = next(results)
+                    if peephole is not None:
+                        for rule, count in hits.items():
+                            peephole.hits[rule] += count
+                    fresh = iter(batch)
+                    func = next(fresh)
+                if cache:
+                    cache.put(key, func)
+            yield func
+
+
+def generate(tree, stream=None, codegen=CodegenOptions(), peephole=None, cache=None, workers=1,
+             stats=None, ir=False):
+    """Generates MASM32 code from AST.
+
+    Returns the code as a string, or writes it to stream (a text file
+    object) as it is produced and returns None. codegen is a
+    CodegenOptions: regalloc switches expression code from the push/pop
+    stack machine to register allocation. strength lowers multiplication
+    and modulo by constants to shifts, lea, and masks and reciprocal
+    multiplication. hot_locals keeps the most read locals of each function
+    in registers. branchless lowers not and cheap ternaries with setcc and
+    cmov, targeting a P6 then. fastcall passes up to three arguments in
+    registers to functions other than main and keeps the variables of
+    those calling none out of memory when it can. When a Peephole is given, each function's code is passed through it.
+    With a FunctionCache, functions whose key is cached are not regenerated.
+    With workers > 1 functions are generated in that many processes; the
+    output is the same as with one. A Stats collects the generate time,
+    instructions per node class and bytes written.
+    With ir set the module is lowered to the IR, optimized by a
+    PassManager and selected by isel instead; codegen, the cache and
+    workers do not apply then.
+    """
 
     if not has_main(tree):
         raise NoEntryError('No entry point has been found.')
 
-    HEADER = (
-        """.386
-.model flat, stdcall
-option casemap:none
-include C://masm32/include/masm32rt.inc 
-main PROTO
-.data
-.code
-""")
+    module = None
+    if ir:
+        with stats.phase('lower') if stats else nullcontext():
+            module = lower(tree)
+        report = PassManager().run(module, stats)
+        if stats is not None:
+            stats.passes['ir'] = report
 
-    generated = tree.visit()
+    if stats is None:
+        out = Emitter(stream, codegen)
+    else:
+        out = InstrumentedEmitter(stats, stream, codegen)
+    with stats.phase('generate') if stats else nullcontext():
+        out.write(HEADER_P6 if codegen.branchless else HEADER)
+        out.write(ENTRY)
+        if module is not None:
+            for func in module.functions:
+                code = select(func)
+                out.write(code if peephole is None else peephole.run_text(code))
+        elif peephole is None and cache is None and workers == 1:
+            walk(tree.visit(out))
+        else:
+            for func in generate_code(tree.body, codegen, peephole, cache, workers, stats):
+                out.write(func)
+        out.write(END)
 
-    ENTRY = ("""
-start:
-    invoke main
-    fn MessageBox,0,str$(eax), "Lab5" ,MB_OK
-    invoke ExitProcess, 0
-    """)
-    END = ("""
+    if stream is None:
+        return out.getvalue()
 
-END start""")
 
-    return f'{HEADER}{ENTRY}{generated}{END}'
+def generate_stream(funcs, stream, codegen=CodegenOptions(), peephole=None, cache=None,
+                    stats=None):
+    """Generates MASM32 code from FunctionDefs as they are produced.
+
+    Each function's code is written to stream and flushed before the next
+    one is taken from funcs, so only one function is in memory at a time.
+    The options are those of generate(). Whether there is a main is only
+    known at the end: NoEntryError is raised after the output was written.
+    """
+
+    if stats is None:
+        out = Emitter(stream, codegen)
+    else:
+        out = InstrumentedEmitter(stats, stream, codegen)
+    out.write(HEADER_P6 if codegen.branchless else HEADER)
+    out.write(ENTRY)
+    found = False
+    for func in funcs:
+        found = found or func.name == 'main'
+        with stats.phase('generate') if stats else nullcontext():
+            if peephole is None and cache is None:
+                walk(func.visit(out))
+            else:
+                for code in generate_code([func], codegen, peephole, cache, 1, stats):
+                    out.write(code)
+        stream.flush()
+    out.write(END)
+    if not found:
+        raise NoEntryError('No entry point has been found.')
@@ -0,0 +1,130 @@
+"""
+Compile statistics and profiling hooks.
+"""
+
+import cProfile
+import json
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Stats:
+    """Counters and phase timings of one compile.
+
+    Passing a Stats to parse() and generate() swaps in counting versions of
+    the lexer, parser and emitter; without one nothing extra runs. hooks
+    are called as hook(phase, seconds) when a phase ends. With profile set,
+    a cProfile profiler runs during every phase.
+    """
+
+    def __init__(self, profile=False):
+        self.timings = Counter()  # phase -> seconds
+        self.tokens = 0  # produced by Lexer.__next__
+        self.lex_seconds = 0.0
+        self.matches = 0  # Parser.match calls
+        self.nodes = Counter()  # AST node class -> count
+        self.node_bytes = Counter()  # AST node class -> bytes of its instances
+        self.instructions = Counter()  # node class -> instructions emitted
+        self.bytes = 0  # assembly written
+        self.passes = {}  # optimizer report
+        self.peephole = None  # peephole rule -> hits, when it ran
+        self.cache = None  # FunctionCache.stats(), when one was used
+        self.hooks = []
+        self.profiler = cProfile.Profile() if profile else None
+
+    @contextmanager
+    def phase(self, name):
+        """Times the enclosed block as phase name."""
+
+        if self.profiler is not None:
+            self.profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.profiler is not None:
+                self.profiler.disable()
+            self.timings[name] += elapsed
+            for hook in self.hooks:
+                hook(name, elapsed)
+
+    def count_nodes(self, node):
+        """Adds the nodes of an AST to the per-class counts and sizes.
+
+        Sizes are the objects' own, as sys.getsizeof() gives them, without
+        the lists and values they refer to.
+        """
+
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(node)
+            elif hasattr(node, 'visit'):
+                kind = type(node).__name__
+                self.nodes[kind] += 1
+                self.node_bytes[kind] += sys.getsizeof(node)
+                stack.extend(getattr(node, name) for name in node.__slots__)
+
+    def as_dict(self):
+        timings = dict(self.timings)
+        if 'parse' in timings:
+            timings['lex'] = self.lex_seconds
+            timings['parse'] -= self.lex_seconds
+        return {
+            'timings': timings,
+            'tokens': self.tokens,
+            'matches': self.matches,
+            'nodes': dict(self.nodes),
+            'bytes_per_node': {name: self.node_bytes[name] / count
+                               for name, count in self.nodes.items()},
+            'instructions': dict(self.instructions),
+            'bytes': self.bytes,
+            'passes': self.passes,
+            'peephole': self.peephole,
+            'cache': self.cache,
+        }
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def dump_profile(self, path):
+        """Writes the profile in the pstats format cProfile uses."""
+
+        self.profiler.dump_stats(path)
+
+
+class CountingLexer:
+    """Wraps a lexer, counting tokens and the time spent producing them."""
+
+    def __init__(self, lexer, stats):
+        self.lexer = lexer
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.lexer, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        tok = next(self.lexer)
+        self.stats.lex_seconds += time.perf_counter() - start
+        self.stats.tokens += 1
+        return tok
+
+
+def emitting_node(frame, emitter):
+    """Returns the class name of the AST node whose code is being written."""
+
+    while frame is not None:
+        obj = frame.f_locals.get('self')
+        if obj is not None and obj is not emitter and hasattr(obj, 'visit'):
+            return type(obj).__name__
+        frame = frame.f_back
+    return None
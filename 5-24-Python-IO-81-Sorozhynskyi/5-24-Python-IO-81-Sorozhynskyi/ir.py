@@ -0,0 +1,411 @@
+"""
+Intermediate representation.
+
+A three-address code between the AST and assembly. A function is a list
+of basic blocks; each block is a list of instructions of which only the
+last one, its terminator (br, jmp or ret), transfers control. Operands
+are constants, source variables and temporaries. Temporaries are
+virtual registers, typed u32 or bool (0 or 1), and are only live inside
+the expression that computes them. Blocks are laid out so that control
+only flows forward, but for the jumps of tail calls back to the entry.
+lower() builds the IR from a Module,
+a PassManager runs optimization passes over it, and isel.select()
+turns each function into MASM32 code.
+"""
+
+import time
+from collections import Counter
+from contextlib import nullcontext
+
+from optimizer import MASK, compute, is_const
+from tree import *
+
+U32 = 'u32'
+BOOL = 'bool'
+BINARY = {'+': 'add', '-': 'sub', '*': 'mul', '%': 'mod'}
+SYMBOLS = {op: symbol for symbol, op in BINARY.items()}
+TERMINATORS = ('br', 'jmp', 'ret')
+
+
+class Const:
+    __slots__ = ('value',)
+
+    type = U32
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, Const) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+
+class Var:
+    """A parameter or local of the source function."""
+
+    __slots__ = ('name',)
+
+    type = U32
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Var) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __str__(self):
+        return self.name
+
+
+class Temp:
+    __slots__ = ('id', 'type')
+
+    def __init__(self, id, type=U32):
+        self.id = id
+        self.type = type
+
+    def __str__(self):
+        return f'%{self.id}'
+
+
+class Instr:
+    """dst = op args; targets are the Blocks a br or jmp goes to, callee
+    the function a call calls."""
+
+    __slots__ = ('op', 'dst', 'args', 'targets', 'callee')
+
+    def __init__(self, op, dst=None, args=(), targets=(), callee=None):
+        self.op = op
+        self.dst = dst
+        self.args = list(args)
+        self.targets = list(targets)
+        self.callee = callee
+
+    def __str__(self):
+        text = self.op
+        if self.callee is not None:
+            text += ' ' + self.callee
+        operands = [str(arg) for arg in self.args] + [f'b{block.id}' for block in self.targets]
+        if operands:
+            text += ' ' + ', '.join(operands)
+        if self.dst is not None:
+            text = f'{self.dst} = {text}'
+        return text
+
+
+class Block:
+    __slots__ = ('id', 'instrs')
+
+    def __init__(self, id):
+        self.id = id
+        self.instrs = []
+
+    def terminator(self):
+        """Returns the last instruction if it ends the block, else None."""
+
+        if self.instrs and self.instrs[-1].op in TERMINATORS:
+            return self.instrs[-1]
+        return None
+
+    def successors(self):
+        term = self.terminator()
+        return term.targets if term is not None else []
+
+
+class Function:
+    """Blocks of one function, the first one being its entry."""
+
+    __slots__ = ('name', 'params', 'blocks', 'temps')
+
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.blocks = []
+        self.temps = 0  # temporaries created so far
+
+    def new_temp(self, type=U32):
+        self.temps += 1
+        return Temp(self.temps, type)
+
+    def variables(self):
+        """Returns the locals stored to, in order of their first store."""
+
+        names = {}
+        for block in self.blocks:
+            for ins in block.instrs:
+                if isinstance(ins.dst, Var) and ins.dst.name not in self.params:
+                    names.setdefault(ins.dst.name, None)
+        return list(names)
+
+    def __str__(self):
+        lines = [f'{self.name}({", ".join(self.params)}):']
+        for block in self.blocks:
+            lines.append(f'b{block.id}:')
+            lines.extend(f'    {ins}' for ins in block.instrs)
+        return '\n'.join(lines)
+
+
+class Module:
+    __slots__ = ('functions',)
+
+    def __init__(self, functions):
+        self.functions = functions
+
+    def __str__(self):
+        return '\n\n'.join(str(func) for func in self.functions)
+
+
+class Lowering:
+    """Lowers one FunctionDef, evaluating expressions from an explicit
+    stack of tasks so that deep trees do not recurse.
+
+    A task is a tuple naming what to do; the operands an instruction
+    needs are taken from, and its result left on, a stack of values.
+    """
+
+    def __init__(self, node):
+        self.func = Function(node.name, list(node.args))
+        self.count = 0  # blocks created
+        self.block = None
+        self.enter(self.new_block())
+        self.entry = None  # block TailCalls jump to
+        self.assigned = set(node.args)
+        self.body = node.body
+
+    def emit(self, op, dst=None, args=(), targets=(), callee=None):
+        self.block.instrs.append(Instr(op, dst, args, targets, callee))
+
+    def new_block(self):
+        self.count += 1
+        return Block(self.count - 1)
+
+    def enter(self, block):
+        """Continues in block, laid out after the ones entered before."""
+
+        self.func.blocks.append(block)
+        self.block = block
+
+    def jump(self, block):
+        """Ends the current block with a jmp to block and continues there."""
+
+        self.emit('jmp', targets=[block])
+        self.enter(block)
+
+    def close(self):
+        """Continues in a new block, which is unreachable if the current
+        one was terminated."""
+
+        self.enter(self.new_block())
+
+    def lower(self):
+        for node in self.body:
+            if isinstance(node, Assign):
+                value = self.expression(node.expression)
+                self.assigned.add(node.id)
+                self.emit('copy', Var(node.id), [value])
+            elif isinstance(node, Return):
+                self.emit('ret', args=[self.expression(node.value)])
+                self.close()
+            elif isinstance(node, Label):
+                self.entry = self.new_block()
+                self.jump(self.entry)
+        if self.block.terminator() is None:
+            self.emit('ret')  # falls off the end like the AST code does
+        return self.func
+
+    def expression(self, node):
+        """Emits the code of an expression, returns the operand holding it."""
+
+        values = []
+        tasks = [('expr', node)]
+        while tasks:
+            task = tasks.pop()
+            kind = task[0]
+            if kind == 'expr':
+                node = task[1]
+                if isinstance(node, Constant):
+                    values.append(Const(int(node.value) & MASK if is_const(node) else node.literal()))
+                elif isinstance(node, Id):
+                    if node.id not in self.assigned:
+                        raise SyntaxError(f'Unknown variable, {node.id}')
+                    values.append(Var(node.id))
+                elif isinstance(node, Bin_Op):
+                    tasks.append(('op', BINARY[node.operation]))
+                    tasks.append(('expr', node.right))
+                    tasks.append(('expr', node.left))
+                elif isinstance(node, Unary_Op):
+                    tasks.append(('not',))
+                    tasks.append(('expr', node.target))
+                elif isinstance(node, Ternary):
+                    tasks.append(('branch', node))
+                    tasks.append(('expr', node.condition))
+                elif isinstance(node, (CallFunc, TailCall)):
+                    kind = 'call' if isinstance(node, CallFunc) else 'tail'
+                    tasks.append((kind, node.name, len(node.args)))
+                    tasks.extend(('expr', arg) for arg in node.args)  # last one first
+            elif kind == 'op':
+                b, a = values.pop(), values.pop()
+                dst = self.func.new_temp()
+                self.emit(task[1], dst, [a, b])
+                values.append(dst)
+            elif kind == 'not':
+                dst = self.func.new_temp(BOOL)
+                self.emit('not', dst, [values.pop()])
+                values.append(dst)
+            elif kind == 'branch':
+                node = task[1]
+                true, false, join = (self.new_block() for _ in range(3))
+                result = self.func.new_temp()
+                self.emit('br', args=[values.pop()], targets=[true, false])
+                self.enter(true)
+                tasks.append(('value', result))
+                tasks.append(('enter', join))
+                tasks.append(('arm', result, join))
+                tasks.append(('expr', node.false_con))
+                tasks.append(('enter', false))
+                tasks.append(('arm', result, join))
+                tasks.append(('expr', node.true_con))
+            elif kind == 'arm':
+                _, result, join = task
+                self.emit('copy', result, [values.pop()])
+                self.emit('jmp', targets=[join])
+            elif kind == 'enter':
+                self.enter(task[1])
+            elif kind == 'value':
+                values.append(task[1])
+            elif kind == 'call':
+                _, name, count = task
+                args = values[len(values) - count:][::-1]
+                del values[len(values) - count:]
+                dst = self.func.new_temp()
+                self.emit('call', dst, args, callee=name)
+                values.append(dst)
+            elif kind == 'tail':
+                _, name, count = task
+                args = values[len(values) - count:][::-1]
+                del values[len(values) - count:]
+                for num, arg in enumerate(args):
+                    if isinstance(arg, Var) and arg.name in self.func.params:
+                        args[num] = self.func.new_temp()  # the params are overwritten next
+                        self.emit('copy', args[num], [arg])
+                for param, arg in zip(self.func.params, args):
+                    self.emit('copy', Var(param), [arg])
+                self.emit('jmp', targets=[self.entry])
+                self.close()
+                values.append(Const(0))  # never used, control does not come back
+        return values.pop()
+
+
+def lower(tree):
+    """Returns the IR Module of an AST Module."""
+
+    return Module([Lowering(func).lower() for func in tree.body])
+
+
+def definitions(func):
+    """Counts the instructions writing each temporary of a function."""
+
+    counts = Counter()
+    for block in func.blocks:
+        for ins in block.instrs:
+            if isinstance(ins.dst, Temp):
+                counts[ins.dst.id] += 1
+    return counts
+
+
+def fold(module):
+    """Computes instructions whose operands are constants and replaces
+    the uses of temporaries that then hold a constant.
+
+    Returns the number of instructions folded.
+    """
+
+    folded = 0
+    for func in module.functions:
+        defs = definitions(func)
+        known = {}  # temporary id -> Const, for those written once
+        for block in func.blocks:
+            for ins in block.instrs:
+                ins.args = [known.get(arg.id, arg) if isinstance(arg, Temp) else arg
+                            for arg in ins.args]
+                if not all(isinstance(arg, Const) and isinstance(arg.value, int)
+                           for arg in ins.args):
+                    continue
+                value = None
+                if ins.op == 'not':
+                    value = 0 if ins.args[0].value else 1
+                elif ins.op in SYMBOLS:
+                    value = compute(SYMBOLS[ins.op], ins.args[0].value, ins.args[1].value)
+                elif ins.op == 'br':
+                    target = ins.targets[0 if ins.args[0].value else 1]
+                    ins.op, ins.args, ins.targets = 'jmp', [], [target]
+                    folded += 1
+                    continue
+                elif ins.op == 'copy' and isinstance(ins.dst, Temp):
+                    value = ins.args[0].value
+                if value is None:
+                    continue
+                if isinstance(ins.dst, Temp) and defs[ins.dst.id] == 1:
+                    known[ins.dst.id] = Const(value)
+                if ins.op != 'copy':
+                    ins.op, ins.args = 'copy', [Const(value)]
+                    folded += 1
+    return folded
+
+
+def remove_unreachable(module):
+    """Drops the blocks no path from the entry reaches, such as the code
+    after a return. Returns the number of instructions removed.
+    """
+
+    removed = 0
+    for func in module.functions:
+        reached = {func.blocks[0].id}
+        stack = [func.blocks[0]]
+        while stack:
+            for block in stack.pop().successors():
+                if block.id not in reached:
+                    reached.add(block.id)
+                    stack.append(block)
+        blocks = []
+        for block in func.blocks:
+            if block.id in reached:
+                blocks.append(block)
+            else:
+                removed += len(block.instrs)
+        func.blocks = blocks
+    return removed
+
+
+PASSES = [fold, remove_unreachable]
+
+
+class PassManager:
+    """Runs a pipeline of passes over an IR Module.
+
+    A pass is a function taking the Module, changing it in place and
+    returning what it did. run() reports that by pass name. Every pass is
+    timed in timings and, given a Stats, as its phase 'ir.<name>'.
+    """
+
+    def __init__(self, passes=None):
+        self.passes = list(PASSES if passes is None else passes)
+        self.timings = Counter()  # pass name -> seconds
+
+    def run(self, module, stats=None):
+        report = {}
+        for ir_pass in self.passes:
+            name = ir_pass.__name__
+            start = time.perf_counter()
+            with stats.phase(f'ir.{name}') if stats else nullcontext():
+                report[name] = ir_pass(module)
+            self.timings[name] += time.perf_counter() - start
+        return report
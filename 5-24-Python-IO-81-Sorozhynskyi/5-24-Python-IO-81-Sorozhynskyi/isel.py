@@ -0,0 +1,194 @@
+"""
+Instruction selection for the IR.
+
+Turns each ir.Function into the MASM32 code of one PROC, as the
+generator's wrapper expects it. Source variables live in the stack
+frame. Temporaries get registers from POOL by a linear scan over the
+blocks in order, which is exact because control only flows forward
+through them, and temporaries are not live across the jumps back of tail
+calls; one live across a call (callees keep no
+registers) or beyond the pool gets a frame slot instead. eax, ecx and
+edx are scratch.
+"""
+
+from bisect import bisect_right
+
+from ir import Const, Temp, Var
+
+POOL = ['ebx', 'esi', 'edi']
+
+
+def live_ranges(func):
+    """Returns the first and last position of each temporary, keyed by
+    id, and the positions of the calls in instruction order."""
+
+    first, last, calls = {}, {}, []
+    pos = 0
+    for block in func.blocks:
+        for ins in block.instrs:
+            for value in ins.args + [ins.dst]:
+                if isinstance(value, Temp):
+                    first.setdefault(value.id, pos)
+                    last[value.id] = pos
+            if ins.op == 'call':
+                calls.append(pos)
+            pos += 1
+    return {temp: (first[temp], last[temp]) for temp in first}, calls
+
+
+def allocate(func):
+    """Returns the register of each temporary kept in one, by id."""
+
+    ranges, calls = live_ranges(func)
+    registers = {}
+    free = list(POOL)
+    active = []  # (end, temp) holding a register
+    for temp, (start, end) in sorted(ranges.items(), key=lambda item: item[1]):
+        for item in [item for item in active if item[0] <= start]:
+            active.remove(item)
+            free.append(registers[item[1]])
+        call = bisect_right(calls, start)  # first call after start
+        if free and not (call < len(calls) and calls[call] < end):
+            registers[temp] = free.pop()
+            active.append((end, temp))
+    return registers
+
+
+def is_memory(operand):
+    return '[' in operand
+
+
+class Selector:
+    """Selects the instructions of one function."""
+
+    def __init__(self, func):
+        self.func = func
+        self.registers = allocate(func)
+        self.slots = {param: f'DWORD ptr[ebp+{num*4 + 8}]' for num, param in enumerate(func.params)}
+        size = 0
+        for name in func.variables():
+            size += 4
+            self.slots[name] = f'DWORD ptr[ebp-{size}]'
+        self.spills = {}
+        for block in func.blocks:
+            for ins in block.instrs:
+                for value in ins.args + [ins.dst]:
+                    if (isinstance(value, Temp) and value.id not in self.registers
+                            and value.id not in self.spills):
+                        size += 4
+                        self.spills[value.id] = f'DWORD ptr[ebp-{size}]'
+        self.size = size
+        self.lines = []
+
+    def operand(self, value):
+        if isinstance(value, Const):
+            return str(value.value)
+        if isinstance(value, Var):
+            return self.slots[value.name]
+        return self.registers.get(value.id) or self.spills[value.id]
+
+    def emit(self, *instructions):
+        self.lines.extend(instructions)
+
+    def label(self, block):
+        return f'{self.func.name}_{block.id}'
+
+    def select(self):
+        """Returns the code of the function."""
+
+        blocks = self.func.blocks
+        targets = {target.id for block in blocks for target in block.successors()}
+        self.emit('push ebp', 'mov ebp, esp')
+        if self.size:
+            self.emit(f'sub esp, {self.size}')
+        for num, block in enumerate(blocks):
+            following = blocks[num + 1] if num + 1 < len(blocks) else None
+            if block.id in targets:
+                self.emit(self.label(block) + ':')
+            for ins in block.instrs:
+                getattr(self, 'select_' + ins.op)(ins, following)
+        return f'\n{self.func.name} PROC\n' + '\n'.join(self.lines) + f'\n{self.func.name} ENDP'
+
+    def select_copy(self, ins, following):
+        dst, src = self.operand(ins.dst), self.operand(ins.args[0])
+        if dst == src:
+            return
+        if is_memory(dst) and is_memory(src):
+            self.emit(f'mov eax, {src}', f'mov {dst}, eax')
+        else:
+            self.emit(f'mov {dst}, {src}')
+
+    def select_add(self, ins, following, op='add'):
+        dst, a, b = self.operand(ins.dst), self.operand(ins.args[0]), self.operand(ins.args[1])
+        if not is_memory(dst) and dst != b:
+            if dst != a:
+                self.emit(f'mov {dst}, {a}')
+            self.emit(f'{op} {dst}, {b}')
+        else:
+            self.emit(f'mov eax, {a}', f'{op} eax, {b}', f'mov {dst}, eax')
+
+    def select_sub(self, ins, following):
+        self.select_add(ins, following, 'sub')
+
+    def divisor(self, value):
+        """Operand mul and div can take: constants go through ecx."""
+
+        if isinstance(value, Const):
+            self.emit(f'mov ecx, {value.value}')
+            return 'ecx'
+        return self.operand(value)
+
+    def select_mul(self, ins, following):
+        self.emit(f'mov eax, {self.operand(ins.args[0])}')
+        self.emit(f'mul {self.divisor(ins.args[1])}', f'mov {self.operand(ins.dst)}, eax')
+
+    def select_mod(self, ins, following):
+        self.emit(f'mov eax, {self.operand(ins.args[0])}')
+        divisor = self.divisor(ins.args[1])
+        self.emit('xor edx, edx', f'div {divisor}', f'mov {self.operand(ins.dst)}, edx')
+
+    def compared(self, value):
+        """Operand cmp can take as its first one."""
+
+        if isinstance(value, Const):
+            self.emit(f'mov ecx, {value.value}')
+            return 'ecx'
+        return self.operand(value)
+
+    def select_not(self, ins, following):
+        value = self.compared(ins.args[0])
+        self.emit('xor eax, eax', f'cmp {value}, 0', 'sete al', f'mov {self.operand(ins.dst)}, eax')
+
+    def select_call(self, ins, following):
+        for arg in reversed(ins.args):
+            self.emit(f'push {self.operand(arg)}')
+        self.emit(f'call {ins.callee}')
+        if ins.args:
+            self.emit(f'add esp, {4 * len(ins.args)}')
+        if ins.dst is not None:
+            self.emit(f'mov {self.operand(ins.dst)}, eax')
+
+    def select_ret(self, ins, following):
+        if ins.args:
+            self.emit(f'mov eax, {self.operand(ins.args[0])}')
+        self.emit('mov esp, ebp', 'pop ebp', 'ret')
+
+    def select_jmp(self, ins, following):
+        if ins.targets[0] is not following:
+            self.emit(f'jmp {self.label(ins.targets[0])}')
+
+    def select_br(self, ins, following):
+        true, false = ins.targets
+        self.emit(f'cmp {self.compared(ins.args[0])}, 0')
+        if false is following:
+            self.emit(f'jne {self.label(true)}')
+        elif true is following:
+            self.emit(f'je {self.label(false)}')
+        else:
+            self.emit(f'je {self.label(false)}', f'jmp {self.label(true)}')
+
+
+def select(func):
+    """Returns the MASM32 code of an ir.Function."""
+
+    return Selector(func).select()
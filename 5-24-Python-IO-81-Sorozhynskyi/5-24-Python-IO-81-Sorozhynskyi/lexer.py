@@ -2,10 +2,13 @@
 Simple lexer library.
 """
 
+import re
+from array import array
 from enum import Enum
 
 HELPERS = ['(', ')', ':', ',']
 OPERATORS = ['-', 'not', '=', '+', '%', '*']
+CHUNK_SIZE = 1 << 16  # characters StreamLexer reads at a time
 
 
 class Tag(Enum):
@@ -29,6 +32,8 @@ class Tag(Enum):
 
 
 class Token:
+    __slots__ = ('tag',)
+
     def __init__(self, tag):
         self.tag = tag
 
@@ -43,6 +48,8 @@ class Token:
 
 
 class Operator(Token):
+    __slots__ = ('value',)
+
     def __init__(self, val):
         tag = None
         if val == '-':
@@ -71,6 +78,8 @@ class Operator(Token):
 
 
 class Num(Token):
+    __slots__ = ('value',)
+
     def __init__(self, val):
         super().__init__(Tag.NUM)
         self.value = val
@@ -86,6 +95,8 @@ class Num(Token):
 
 
 class Char(Token):
+    __slots__ = ('value',)
+
     def __init__(self, val):
         super().__init__(Tag.CHAR)
         self.value = val
@@ -98,6 +109,8 @@ class Char(Token):
 
 
 class Word(Token):
+    __slots__ = ('lexeme',)
+
     def __init__(self, tag, lex):
         super().__init__(tag)
         self.lexeme = lex
@@ -109,33 +122,62 @@ class Word(Token):
         return self.__str__()
 
 
+# Tokens without a payload never change, so each kind is allocated once.
+NEWLINE_TOKEN = Token(Tag.NEWLINE)
+INDENT_TOKEN = Token(Tag.INDENT)
+DEDENT_TOKEN = Token(Tag.DEDENT)
+EOF_TOKEN = Token(Tag.EOF)
+OPERATOR_TOKENS = {op: Operator(op) for op in OPERATORS if len(op) == 1}
+HELPER_TOKENS = {hl: Token(hl) for hl in HELPERS}
+
+
 class Lexer:
-    def __init__(self, inpstr):  # inputstream(iterator)
-        self.inpstr = inpstr
+    """Scans one source string by position.
+
+    The cursor is an index into ``self.src``; lookahead is a slice of the
+    same string, so no characters are ever copied into a side buffer.
+    Runs of spaces, identifiers and numbers are consumed with precompiled
+    regexes, single-character tokens are dispatched through a table.
+    """
+
+    def __init__(self, src):  # source text
+        if not isinstance(src, str):
+            src = ''.join(src)
+        self.src = src
+        self.end_pos = len(src)
+        self.pos = 0
         self.indstk = [0]  # indentstack
         self.pended = 0
         self.words = {}  # dict keywords, IDs ->TokenTag
+        self.nums = {}  # integer literal -> shared NUM token
         self.isnl = True  # logicline detection
-        self.buff = ''
-        self.curr = next(self.inpstr, '')
         self.line = 1
         self.wasind = False
 
     def __iter__(self):
         return self
 
-    def get_raw(self):
-        self.curr = next(self.inpstr, '')
+    @property
+    def curr(self):
+        """Character under the cursor, '' at the end of input."""
+
+        return self.src[self.pos] if self.pos < self.end_pos else ''
 
     def get(self):
-        if self.buff != '':
-            self.curr = self.buff[0]
-            self.buff = self.buff[1:]
-        else:
-            self.get_raw()
+        self.pos += 1
+
+    def tell(self):
+        """Offset of the cursor in the whole input."""
+
+        return self.pos
 
-    def put(self):
-        self.buff += self.curr
+    def text(self, start, end=None):
+        """Returns the input between two offsets from tell()."""
+
+        return self.src[start:end]
+
+    def release(self, offset):
+        """Tells that text() will not be asked for input before offset."""
 
     def reserve(self, w):
         """Adds new entry to words, associating the lexeme with the token."""
@@ -145,52 +187,50 @@ class Lexer:
     def number(self):
         """Returns NUM token."""
 
-        v = 0
+        src = self.src
+        pos = self.pos
+        if src.startswith('0', pos):
+            pos += 1
+
+        if src.startswith('x', pos):
+            m = HEX_RE.match(src, pos + 1)  # int('', 16) rejects a bare 0x
+            self.pos = m.end()
+            return Num(int(m.group(), 16))
+
+        m = DECIMAL_RE.match(src, pos)
+        self.pos = m.end()
+        v = int(m.group(1)) if m.group(1) else 0
         p = 0
-        if self.curr == '0':
-            self.get()
-
-        if self.curr == 'x':
-            self.get()
-            hex_digits = 'ABCDEFabcdef'
-            hex_number = ''
-            while (self.curr.isdigit() or self.curr in hex_digits) and self.curr != '':
-                hex_number += self.curr
-                # print(hex_number)
-                self.get()
-            v = int(hex_number, 16)
-        else:
-            part = False
-            decimal_power = 0
-            while self.curr.isdigit() or self.curr == '.':
-                if self.curr == '.':
-                    part = True
-                    self.get()
-                if not part:
-                    v = v * 10 + int(self.curr)
-                else:
-                    decimal_power += 1
-                    p = p + int(self.curr)/10**decimal_power
-                self.get()
-        # self.put() # TODO ??????????????????WTF???????????????????????
+        decimal_power = 0
+        fraction = m.group(2) or ''
+        i = 0
+        while i < len(fraction):
+            if fraction[i] == '.':
+                i += 1
+                if i == len(fraction) or fraction[i] == '.':
+                    raise ValueError(f'at line {self.line}: expected digit after decimal point')
+            decimal_power += 1
+            p = p + int(fraction[i])/10**decimal_power
+            i += 1
         return Num(v+p)
 
-    def word(self):
+    def word(self, m=None):
         """Returns Word-type token (IDs, keywords)."""
 
-        s = ''
-        w = None
-        while self.curr.isalpha():
-            s += self.curr
-            self.get()
-        # self.put()
-        # print(s, self.words)
+        if m is None:
+            m = WORD_RE.match(self.src, self.pos)
+        s = m.group('word')
+        if not s.isalpha():  # \w also admits a few numeric characters
+            s = s[:next(i for i, c in enumerate(s) if not c.isalpha())]
+            if not s:
+                raise SyntaxError(f'illegal character, at line {self.line}: {m.group("word")[0]}')
+        self.pos = m.start('word') + len(s)
         w = self.words.get(s)
         if w is not None:
             return w
 
         w = Word(Tag.ID, s)
-        self.words.setdefault(w.lexeme, w)
+        self.words[s] = w
         return w
 
     def char(self):
@@ -208,80 +248,71 @@ class Lexer:
         return Char(c)
 
     def cut_lines(self):
-        while self.isnl and (self.curr == '\n' or self.curr == ' '):
-            if self.curr == '\n':
+        src = self.src
+        while self.isnl and self.pos < self.end_pos and src[self.pos] in '\n ':
+            if src[self.pos] == '\n':
                 self.line += 1
-                self.get()
+                self.pos += 1
             if self.curr == ' ' and self.is_indent():
-                self.get()
+                self.pos += 1
                 break
             self.cut_spaces()
 
     def cut_spaces(self):
-        spaces = 0
-        while self.curr == ' ':
-            self.get()
-            spaces += 1
-        return spaces
+        start = self.pos
+        self.pos = SPACES_RE.match(self.src, start).end()
+        return self.pos - start
 
     def is_indent(self):
         if self.curr != ' ':
             return False
-        tmp = self.curr
-        while self.curr == ' ':
-            self.get_raw()
-            self.put()
-        ch = self.curr
-        self.curr = tmp
-        return not (ch == '\n' or ch == '')
+        ahead = SPACES_RE.match(self.src, self.pos).end()
+        return ahead < self.end_pos and self.src[ahead] != '\n'
 
     def newline(self):
         self.line += 1
         self.isnl = True
         self.wasind = False
-        self.get()
-        return Token(Tag.NEWLINE)
+        return NEWLINE_TOKEN
 
     def end(self):
         if self.pended > 0:
             self.pended -= 1
-            return Token(Tag.DEDENT)
-        return Token(Tag.EOF)
+            return DEDENT_TOKEN
+        return EOF_TOKEN
 
     def other(self):
-        if self.curr.isdigit():
+        c = self.curr
+        handler = DISPATCH.get(c)
+        if handler is not None:
+            return handler(self)
+        if '0' <= c <= '9':  # isdigit() also admits other scripts' digits
             return self.number()
-        if self.curr in OPERATORS:
-            return self.operator()
-        if self.curr.isalpha():
+        if c.isalpha():
             return self.word()
-        if self.curr == '\'':
-            return self.char()
-        if self.curr in HELPERS:
-            return self.helper()
-        raise SyntaxError(f'illegal character, at line {self.line}: {self.curr}')
+        raise SyntaxError(f'illegal character, at line {self.line}: {c}')
 
     def operator(self):
-        op = Operator(self.curr)
-        self.get()
+        op = OPERATOR_TOKENS[self.src[self.pos]]
+        self.pos += 1
         return op
 
     def helper(self):
-        hl = Token(self.curr)
-        self.get()
+        hl = HELPER_TOKENS[self.src[self.pos]]
+        self.pos += 1
         return hl
 
     def indent(self):
         self.wasind = False
         self.isnl = False
         self.pended += 1
-        return Token(Tag.INDENT)
+        return INDENT_TOKEN
 
     def dedent(self):
         self.wasind = False
         self.indstk.pop()
         self.pended -= 1
-        return Token(Tag.DEDENT)
+        return DEDENT_TOKEN
 
     def dent(self):
         width = self.cut_spaces()
@@ -297,26 +328,197 @@ class Lexer:
     def __next__(self):
         """Returns the next token."""
 
+        if self.isnl:
+            return self.line_start()
+
+        if self.pos >= self.end_pos:
+            return self.end()
+
+        m = TOKEN_RE.match(self.src, self.pos)
+        kind = m.lastgroup
+        if kind is None:
+            self.pos = m.end()
+            return self.other()
+        if kind == 'word':
+            return self.word(m)
+        self.pos = m.end()
+        if kind == 'int':
+            lit = m.group(kind)
+            num = self.nums.get(lit)
+            if num is None:
+                num = self.nums[lit] = Num(int(lit))
+            return num
+        if kind == 'op':
+            return OPERATOR_TOKENS[m.group(kind)]
+        if kind == 'helper':
+            return HELPER_TOKENS[m.group(kind)]
+        return self.newline()
+
+    def line_start(self):
+        """Handles blank lines and indentation at the start of a logical line."""
+
         self.cut_lines()
 
-        if self.curr == '':
+        if self.pos >= self.end_pos:
             return self.end()
 
-        if self.isnl and self.curr == ' ':
+        c = self.src[self.pos]
+        if c == ' ':
             return self.dent()
-
-        if self.isnl and not self.curr == '\n' and len(self.indstk) > 1 and not self.wasind:
+        if c != '\n' and len(self.indstk) > 1 and not self.wasind:
             return self.dedent()
-        # elif self.isnl and len(self.indstk) > 1 :
-        #     self.indstk.pop()
-        #     self.isnl = False
-        #     return self.dedent()
-        # print(self.curr, self.isnl, self.is_indent())
-
         self.isnl = False
+        return self.__next__()
+
 
-        self.cut_spaces()
+SPACES_RE = re.compile(' *')
+WORD_RE = re.compile(r'(?P<word>[^\W\d_]+)')
+HEX_RE = re.compile('[0-9A-Fa-f]*')
+TOKEN_RE = re.compile(r' *(?:(?P<word>[^\W\d_]+)|(?P<int>[0-9]+)(?![.x0-9])|(?P<op>[-=+%*])|(?P<helper>[():,])|(?P<newline>\n))?')
+DECIMAL_RE = re.compile(r'([0-9]*)(\.[0-9.]*)?')
 
-        if not self.isnl and self.curr == '\n':
-            return self.newline()
-        return self.other()
+# first character -> scanning method, for everything that is not a letter
+DISPATCH = {c: Lexer.number for c in '0123456789'}
+DISPATCH.update({c: Lexer.operator for c in OPERATORS if len(c) == 1})
+DISPATCH.update({c: Lexer.helper for c in HELPERS})
+DISPATCH['\''] = Lexer.char
+
+
+class StreamLexer(Lexer):
+    """Scans a text file object, read in chunks of whole lines.
+
+    self.src is a window on the input that always ends at a line break
+    (or the end of the input), so every token and indentation lookahead
+    falls inside it and the scanning methods work unchanged; the window
+    is refilled when the cursor runs off its end. Text before the offset
+    given to release() is dropped on refill, so memory is bounded by the
+    chunk size and the text still asked for, not the input size. The
+    input reads as if it ended with one more newline, like make_lexer().
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        super().__init__('')
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.offset = 0  # of src[0] in the whole input
+        self.released = 0
+        self.exhausted = False
+        self.fill()
+
+    def tell(self):
+        return self.offset + self.pos
+
+    def text(self, start, end=None):
+        return self.src[start - self.offset:None if end is None else end - self.offset]
+
+    def release(self, offset):
+        self.released = offset
+
+    def fill(self):
+        """Appends the next chunk to the window, False at the end of input."""
+
+        if self.exhausted:
+            return False
+        data = self.stream.read(self.chunk_size)
+        if data and not data.endswith('\n'):
+            data += self.stream.readline()
+        if not data.endswith('\n'):  # the input is over
+            self.exhausted = True
+            data += '\n'
+        drop = max(0, min(self.pos, self.released - self.offset))
+        self.src = self.src[drop:] + data
+        self.offset += drop
+        self.pos -= drop
+        self.end_pos = len(self.src)
+        return True
+
+    def cut_lines(self):
+        super().cut_lines()
+        while self.isnl and self.pos >= self.end_pos and self.fill():
+            super().cut_lines()
+
+    def end(self):
+        if self.fill():
+            return self.__next__()
+        return super().end()
+
+
+class TokenBuffer:
+    """Packed token stream.
+
+    Drains a lexer into parallel arrays: tag ids, indices into a table of
+    the distinct payload tokens (words, numbers, chars), the line counter
+    and the cursor offset after each token. Iterating it replays the
+    stream with the same line and curr attributes a Lexer exposes, so a
+    Parser can consume it unchanged.
+    """
+
+    def __init__(self, lexer):
+        self.src = lexer.src
+        self.tags = array('B')
+        self.values = array('I')
+        self.lines = array('I')
+        self.ends = array('I')
+        self.table = []
+        ids = {}
+
+        tok = None
+        while tok is None or tok.tag != Tag.EOF:
+            start = lexer.pos
+            tok = next(lexer)
+            if tok is None:
+                raise SyntaxError(f'at line {lexer.line}: inconsistent indentation')
+            if tok.tag not in FIXED_TOKENS and lexer.pos == start:
+                # a payload token always consumes text; draining would not end
+                raise SyntaxError(f'at line {lexer.line}: lexer made no progress')
+            value = 0
+            if tok.tag not in FIXED_TOKENS:
+                value = ids.get(id(tok))
+                if value is None:
+                    value = ids[id(tok)] = len(self.table)
+                    self.table.append(tok)
+            self.tags.append(TAG_IDS[tok.tag])
+            self.values.append(value)
+            self.lines.append(lexer.line)
+            self.ends.append(lexer.pos)
+
+        self.index = 0
+        self.line = 1
+        self.pos = 0
+        self.curr = self.src[:1]
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self.tags)
+
+    def tell(self):
+        return self.pos
+
+    def text(self, start, end=None):
+        return self.src[start:end]
+
+    def release(self, offset):
+        pass
+
+    def __next__(self):
+        """Returns the next token, EOF once the stream is exhausted."""
+
+        i = self.index
+        if i + 1 < len(self.tags):
+            self.index = i + 1
+        self.line = self.lines[i]
+        self.pos = self.ends[i]
+        self.curr = self.src[self.pos:self.pos + 1]
+        tag = TAGS[self.tags[i]]
+        tok = FIXED_TOKENS.get(tag)
+        if tok is None:
+            tok = self.table[self.values[i]]
+        return tok
+
+
+TAGS = list(Tag) + HELPERS
+TAG_IDS = {tag: num for num, tag in enumerate(TAGS)}
+FIXED_TOKENS = {tok.tag: tok for tok in (NEWLINE_TOKEN, INDENT_TOKEN, DEDENT_TOKEN, EOF_TOKEN,
+                                         *OPERATOR_TOKENS.values(), *HELPER_TOKENS.values())}
@@ -1,18 +1,182 @@
-from myparser import parse
-from generator import generate
-
-try:
-    FILENAME_I = '5-24-Python-IO-81-Sorozhynskyi.txt'
-    FILENAME_O = '5-24-Python-IO-81-Sorozhynskyi.asm'
-    code = ''
-    with open(FILENAME_I) as f:
-        code = f.read()
-    print(code)
-    gp = generate(parse(code))
-    print(gp)
-    with open(FILENAME_O, 'w') as f:
-        f.write(gp)
-    input('Press ENTER to exit')
-except Exception as err:
-    print(f'error {err}')
-    input('Press ENTER to exit')
+"""
+Command line compiler.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from myparser import parse, parse_stream
+from emitter import CodegenOptions
+from generator import generate, generate_stream
+from optimizer import INLINE_BUDGET, optimize, optimize_stream
+from peephole import Peephole
+from cache import FunctionCache
+from instrument import Stats
+
+
+def output_path(path, output_dir=None):
+    """Returns where the assembly for a source file goes."""
+
+    base = os.path.splitext(path)[0] + '.asm'
+    if output_dir is None:
+        return base
+    return os.path.join(output_dir, os.path.basename(base))
+
+
+def compile_file(path, out_path, fold=True, codegen=CodegenOptions(), peephole=False,
+                 cache_dir=None, stats=False, profile=False, inline=0, tailcalls=False,
+                 evaluate=False, stream=False, ir=False, cse=False, dead_stores=False,
+                 dead_functions=False, workers=1):
+    """Compiles one file; returns (path, out_path, seconds, error or None).
+
+    stats writes a JSON report next to the output, profile a pstats file;
+    the report includes the peephole rule hits and the cache counters.
+    stream reads, compiles and writes one function at a time; inline,
+    evaluate, dead_functions and workers are ignored then. workers is the
+    number of processes generating the functions of the file.
+    """
+
+    start = time.perf_counter()
+    try:
+        report = Stats(profile) if stats or profile else None
+        if not stream:
+            with open(path) as f:
+                code = f.read()
+            tree = parse(code, stats=report)
+            if report is None:
+                optimize(tree, fold=fold, inline=inline, tailcalls=tailcalls, evaluate=evaluate,
+                         cse=cse, dead_stores=dead_stores, dead_functions=dead_functions)
+            else:
+                with report.phase('optimize'):
+                    report.passes = optimize(tree, fold=fold, inline=inline, tailcalls=tailcalls,
+                                             evaluate=evaluate, cse=cse, dead_stores=dead_stores,
+                                             dead_functions=dead_functions)
+        cache = FunctionCache(cache_dir) if cache_dir else None
+        peephole = Peephole() if peephole else None
+        with open(out_path, 'w') as f:
+            try:
+                if stream:
+                    with open(path) as source:
+                        funcs = optimize_stream(parse_stream(source, stats=report), fold=fold,
+                                                tailcalls=tailcalls, cse=cse,
+                                                dead_stores=dead_stores, stats=report)
+                        generate_stream(funcs, f, codegen=codegen, peephole=peephole,
+                                        cache=cache, stats=report)
+                else:
+                    generate(tree, f, codegen=codegen, peephole=peephole, cache=cache,
+                             stats=report, ir=ir, workers=workers)
+            except BaseException:
+                f.close()
+                os.remove(out_path)
+                raise
+        if report is not None:
+            report.peephole = peephole and dict(peephole.hits)
+            report.cache = cache and cache.stats()
+        if stats:
+            report.dump_json(out_path + '.stats.json')
+        if profile:
+            report.dump_profile(out_path + '.prof')
+    except Exception as err:
+        return path, out_path, time.perf_counter() - start, f'{type(err).__name__}: {err}'
+    return path, out_path, time.perf_counter() - start, None
+
+
+def expand(patterns):
+    """Expands globs, keeping order and dropping duplicates."""
+
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        for path in matches:
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Compiles source files to MASM32 assembly.')
+    ap.add_argument('inputs', nargs='+', help='source files or glob patterns')
+    ap.add_argument('-o', '--output-dir', help='write .asm files here instead of next to the inputs')
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='files compiled in parallel')
+    ap.add_argument('--workers', type=int, default=1, metavar='N',
+                    help='processes generating the functions of each file')
+    ap.add_argument('--no-fold', action='store_true', help='disable constant folding')
+    ap.add_argument('--inline', type=int, nargs='?', const=INLINE_BUDGET, default=0, metavar='NODES',
+                    help=f'inline functions returning at most NODES nodes (default {INLINE_BUDGET})')
+    ap.add_argument('--evaluate', action='store_true',
+                    help='compute calls with constant arguments at compile time')
+    ap.add_argument('--tail-calls', action='store_true', help='turn self tail calls into jumps')
+    ap.add_argument('--cse', action='store_true',
+                    help='compute each value once per function, keeping it in a local')
+    ap.add_argument('--dead-stores', action='store_true',
+                    help='drop assignments whose value is never read')
+    ap.add_argument('--dead-functions', action='store_true',
+                    help='only emit the functions main calls, directly or not')
+    ap.add_argument('--regalloc', action='store_true', help='evaluate expressions in registers')
+    ap.add_argument('--strength', action='store_true',
+                    help='multiply and take modulo by constants without mul and div')
+    ap.add_argument('--hot-locals', action='store_true',
+                    help='keep the most read locals of each function in registers')
+    ap.add_argument('--branchless', action='store_true',
+                    help='use setcc and cmov for not and cheap ternaries (targets a P6)')
+    ap.add_argument('--fastcall', action='store_true',
+                    help='pass up to 3 arguments in ecx, edx and ebx to functions but main')
+    ap.add_argument('--ir', action='store_true',
+                    help='generate code through the IR (no --regalloc, --strength, --hot-locals,'
+                         ' --branchless, --fastcall, --stream, --cache, --workers)')
+    ap.add_argument('--peephole', action='store_true', help='run the peephole optimizer')
+    ap.add_argument('--stream', action='store_true',
+                    help='read, compile and write one function at a time'
+                         ' (no --inline, --evaluate, --dead-functions, --workers)')
+    ap.add_argument('--cache', metavar='DIR', help='per-function code cache directory')
+    ap.add_argument('--stats', action='store_true', help='write <output>.stats.json per file')
+    ap.add_argument('--profile', action='store_true', help='write a cProfile <output>.prof per file')
+    args = ap.parse_args(argv)
+
+    if args.stream and (args.inline or args.evaluate or args.dead_functions or args.workers > 1):
+        ap.error('--stream cannot be combined with --inline, --evaluate, --dead-functions'
+                 ' or --workers')
+    if args.ir and (args.regalloc or args.strength or args.hot_locals or args.branchless
+                    or args.fastcall or args.stream or args.cache or args.workers > 1):
+        ap.error('--ir cannot be combined with --regalloc, --strength, --hot-locals, --branchless,'
+                 ' --fastcall, --stream, --cache or --workers')
+    paths = expand(args.inputs)
+    if not paths:
+        ap.error('no input files')
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    codegen = CodegenOptions(regalloc=args.regalloc, strength=args.strength,
+                             hot_locals=args.hot_locals, branchless=args.branchless,
+                             fastcall=args.fastcall)
+    options = dict(fold=not args.no_fold, codegen=codegen, peephole=args.peephole,
+                   cache_dir=args.cache, stats=args.stats, profile=args.profile, inline=args.inline,
+                   tailcalls=args.tail_calls, evaluate=args.evaluate, stream=args.stream,
+                   ir=args.ir, cse=args.cse, dead_stores=args.dead_stores,
+                   dead_functions=args.dead_functions, workers=args.workers)
+    start = time.perf_counter()
+    jobs = [(path, output_path(path, args.output_dir)) for path in paths]
+    if args.jobs <= 1 or len(jobs) == 1:
+        results = [compile_file(path, out, **options) for path, out in jobs]
+    else:
+        with ProcessPoolExecutor(min(args.jobs, len(jobs))) as pool:
+            futures = [pool.submit(compile_file, path, out, **options) for path, out in jobs]
+            results = [future.result() for future in futures]
+
+    failed = 0
+    for path, out, seconds, error in results:
+        if error is None:
+            print(f'{seconds:9.3f}s  {path} -> {out}')
+        else:
+            failed += 1
+            print(f'{seconds:9.3f}s  {path}: {error}')
+    print(f'{len(results) - failed} compiled, {failed} failed in {time.perf_counter() - start:.3f}s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,35 +2,87 @@
 Parser library.
 """
 
+from instrument import CountingLexer
 from lexer import *
 from tree import *
 
-functions = []
+# Keyword tokens are never mutated, so every lexer shares the same ones.
+KEYWORDS = (Word(Tag.DEF, 'def'), Word(Tag.LOGZAP, 'not'), Word(Tag.RETURN, 'return'),
+            Word(Tag.IF, 'if'), Word(Tag.ELSE, 'else'))
+
+
+class SymbolTable:
+    """Functions of one module keyed by (name, arity).
+
+    A def header is indexed as soon as it is read, so calls to functions
+    defined earlier (or recursive ones) resolve at once. Calls that do not
+    resolve yet are recorded with their line and checked by resolve()
+    once every header of the module has been indexed.
+    """
+
+    def __init__(self):
+        self.functions = {}
+        self.unresolved = []
+
+    def define(self, name, params):
+        self.functions[name, len(params)] = params
+
+    def reference(self, name, arity, line):
+        """Notes a call of name with arity arguments made at line."""
+
+        if (name, arity) not in self.functions:
+            self.unresolved.append((name, arity, line))
+
+    def resolve(self):
+        """Raises SyntaxError for the first call of an undefined function."""
+
+        for name, arity, line in self.unresolved:
+            if (name, arity) not in self.functions:
+                raise SyntaxError(f'at line {line}: Unknown Function, {name}')
+        self.unresolved = []
 
 
 class Parser:
     def __init__(self, lexer):
         self.lexer = lexer
-        self.curr = next(self.lexer, Token(Tag.EOF))
+        self.symbols = SymbolTable()
+        self.curr = next(self.lexer, EOF_TOKEN)
 
     def match(self, tag):
         """Matches current token tag with the given and advances it."""
         if self.curr is None or self.curr.tag != tag:
             raise SyntaxError(f'at line {self.lexer.line}: expected {tag}, got {self.curr}')
-        self.curr = next(self.lexer, Token(Tag.EOF))
+        self.curr = next(self.lexer, EOF_TOKEN)
 
     def module(self):
         """Generates Module root node."""
 
-        funcs = []
+        return Module(list(self.functions()))
+
+    def functions(self):
+        """Generates the FunctionDef nodes of the module one at a time.
+
+        Each is yielded with its source text once the next def is reached.
+        Calls are resolved before the last one, so an unknown function is
+        only reported after all the others were yielded.
+        """
+
+        func = start = None
         while self.curr.tag != Tag.EOF:
-            funcs.append(self.func())
-        return Module(funcs)
+            end = self.lexer.tell() - len('def')  # lexer stands after def
+            if func is not None:
+                func.source = self.lexer.text(start, end).rstrip()
+                self.lexer.release(end)
+                yield func
+            func, start = self.func(), end
+        self.symbols.resolve()
+        if func is not None:
+            func.source = self.lexer.text(start).rstrip()
+            yield func
 
     def func(self):
         """Generates FunctionDef node."""
 
-        global functions
         params = []
         self.match(Tag.DEF)
         name = self.curr.lexeme
@@ -43,7 +95,7 @@ class Parser:
                 self.match(',')
                 params.append(self.curr.lexeme)
                 self.match(Tag.ID)
-        functions.append((name, len(params)))
+        self.symbols.define(name, params)
         self.match(')')
         self.match(':')
         body = []
@@ -106,74 +158,113 @@ class Parser:
             self.match(Tag.EQUAL)
             return Assign(id, Bin_Op(Id(id), self.expression(), '+'))
 
-    def div_mul(self):
-        left = self.term()
-        while self.curr.tag == Tag.PROZENT or self.curr.tag == Tag.MNOZ:
-            op = '%' if self.curr == Tag.PROZENT else '*'
-            self.match(self.curr.tag)
-            right = self.term()
-            left = Bin_Op(left, right, op)
-        return left
-
-    def plus_minus(self):
-        left = self.div_mul()
-        while self.curr.tag == Tag.MIN or self.curr.tag == Tag.PLUS:
-            op = '-' if self.curr.tag == Tag.MIN else '+'
-            self.match(self.curr.tag)
-            right = self.div_mul()
-            # print(op)
-            left = Bin_Op(left, right, op)
-        return left
-
-    def operator_not(self):
-        if self.curr.tag == Tag.LOGZAP:
-            self.match(Tag.LOGZAP)
-            return Unary_Op(self.expression(), 'not')
-        return self.plus_minus()
-
     def expression(self):
-        true_con = self.operator_not()
-        if self.curr.tag == Tag.IF:
-            self.match(Tag.IF)
-            condition = self.operator_not()
-            self.match(Tag.ELSE)
-            false_con = self.expression()
-            return Ternary(true_con, false_con, condition)
-        return true_con
-
-    def term(self):
-        # print(self.curr)
-        name = self.curr
-        if self.curr.tag == Tag.NUM:
-            self.match(Tag.NUM)
-            return Constant(name.value)
-        elif self.curr.tag == Tag.CHAR:
-            self.match(Tag.CHAR)
-            return Constant(name.value)
-        elif self.curr.tag == Tag.ID:
-            id = self.curr.lexeme
-            self.match(Tag.ID)
-            if self.curr.tag == '(':
-                self.match('(')
-                arguments = []
-                if self.curr.tag != ')':
-                    arguments.append(self.expression())
-                    while self.curr.tag != ')':
+        """Parses an expression with an explicit stack instead of recursion.
+
+        The grammar is the recursive one
+
+            expression   = operator_not ['if' operator_not 'else' expression]
+            operator_not = 'not' expression | plus_minus
+            plus_minus   = div_mul {('-' | '+') div_mul}
+            div_mul      = term {('%' | '*') term}
+            term         = NUM | CHAR | ID ['(' [expression {',' expression}] ')']
+
+        but every rule waiting for a subexpression is kept on a stack as a
+        tuple of the rule name and its partial result, so the nesting depth
+        is only bounded by memory.
+        """
+
+        stack = []
+        rule = 'expression'
+        while True:
+            # enter rules down to the next term
+            while rule != 'term':
+                if rule == 'expression':
+                    stack.append(('expression',))
+                    rule = 'operator_not'
+                elif rule == 'operator_not' and self.curr.tag == Tag.LOGZAP:
+                    self.match(Tag.LOGZAP)
+                    stack.append(('not',))
+                    rule = 'expression'
+                elif rule == 'operator_not':
+                    stack.append(('plus_minus', None, None))
+                    rule = 'div_mul'
+                else:
+                    stack.append(('div_mul', None, None))
+                    rule = 'term'
+
+            name = self.curr
+            if self.curr.tag == Tag.NUM:
+                self.match(Tag.NUM)
+                value = Constant(name.value)
+            elif self.curr.tag == Tag.CHAR:
+                self.match(Tag.CHAR)
+                value = Constant(name.value)
+            elif self.curr.tag == Tag.ID:
+                self.match(Tag.ID)
+                if self.curr.tag == '(':
+                    self.match('(')
+                    if self.curr.tag != ')':
+                        stack.append(('call', name.lexeme, []))
+                        rule = 'expression'
+                        continue
+                    value = self.call(name.lexeme, [])
+                else:
+                    value = Id(name.lexeme)
+            else:
+                value = 'hz'
+
+            # hand the value up until some rule wants more input
+            rule = None
+            while rule is None:
+                if not stack:
+                    return value
+                pending = stack.pop()
+                kind = pending[0]
+                if kind == 'div_mul':
+                    if pending[1] is not None:
+                        value = Bin_Op(pending[1], value, pending[2])
+                    if self.curr.tag == Tag.PROZENT or self.curr.tag == Tag.MNOZ:
+                        op = '%' if self.curr == Tag.PROZENT else '*'
+                        self.match(self.curr.tag)
+                        stack.append(('div_mul', value, op))
+                        rule = 'term'
+                elif kind == 'plus_minus':
+                    if pending[1] is not None:
+                        value = Bin_Op(pending[1], value, pending[2])
+                    if self.curr.tag == Tag.MIN or self.curr.tag == Tag.PLUS:
+                        op = '-' if self.curr.tag == Tag.MIN else '+'
+                        self.match(self.curr.tag)
+                        stack.append(('plus_minus', value, op))
+                        rule = 'div_mul'
+                elif kind == 'expression':
+                    if self.curr.tag == Tag.IF:
+                        self.match(Tag.IF)
+                        stack.append(('condition', value))
+                        rule = 'operator_not'
+                elif kind == 'condition':
+                    self.match(Tag.ELSE)
+                    stack.append(('ternary', pending[1], value))
+                    rule = 'expression'
+                elif kind == 'ternary':
+                    value = Ternary(pending[1], value, pending[2])
+                elif kind == 'not':
+                    value = Unary_Op(value, 'not')
+                else:
+                    pending[2].append(value)
+                    if self.curr.tag != ')':
                         self.match(',')
-                        arguments.append(self.expression())
-                self.match(')')
-                if (id, len(arguments)) not in functions:
-                    raise SyntaxError(f'at line {self.lexer.line}: Unknown Function, {id}')
-                return CallFunc(id, arguments)
-            #if self.curr.tag == '-' and self.lexer.buff ==
-            return Id(id)
-
-
-        # elif self.curr.tag == Tag.LOGZAP:
-        #     self.match(Tag.LOGZAP)
-        #     return Unary_Op(self.expression(), 'not')
-        else:
-            return 'hz'
+                        stack.append(pending)
+                        rule = 'expression'
+                    else:
+                        value = self.call(pending[1], pending[2])
+
+    def call(self, id, arguments):
+        """Closes the argument list of a call and generates CallFunc node."""
+
+        self.match(')')
+        self.symbols.reference(id, len(arguments), self.lexer.line)
+        return CallFunc(id, arguments)
 
     def return_stmt(self):
         """Generates Return node."""
@@ -181,16 +272,68 @@ class Parser:
         return Return(self.expression())
 
 
-def parse(code):
-    """Parses Python source file."""
+class InstrumentedParser(Parser):
+    """Parser that counts match calls in a Stats."""
+
+    def __init__(self, lexer, stats):
+        self.stats = stats
+        super().__init__(lexer)
+
+    def match(self, tag):
+        self.stats.matches += 1
+        super().match(tag)
+
+
+def make_lexer(code):
+    """Returns a Lexer over source code with the keywords reserved.
+
+    code is a string or a text file object, read by a StreamLexer.
+    """
+
+    lx = Lexer(code+'\n') if isinstance(code, str) else StreamLexer(code)
+    for word in KEYWORDS:
+        lx.reserve(word)
+    return lx
+
+
+def parse(code, packed=False, stats=None):
+    """Parses Python source file.
+
+    With packed=True the whole token stream is first stored in a compact
+    TokenBuffer and the parser reads from that. A Stats collects token,
+    match and node counts and the parse time.
+    """
+
+    if stats is None:
+        lx = make_lexer(code)
+        ps = Parser(TokenBuffer(lx) if packed else lx)
+        return ps.module()
+
+    with stats.phase('parse'):
+        lx = CountingLexer(make_lexer(code), stats)
+        ps = InstrumentedParser(TokenBuffer(lx) if packed else lx, stats)
+        tree = ps.module()
+    stats.count_nodes(tree)
+    return tree
+
+
+def parse_stream(stream, stats=None):
+    """Parses a source file object, yielding one FunctionDef at a time.
 
-    lx = Lexer(iter(code+'\n'))
-    lx.reserve(Word(Tag.DEF, 'def'))
-    lx.reserve(Word(Tag.LOGZAP, 'not'))
-    lx.reserve(Word(Tag.RETURN, 'return'))
-    lx.reserve(Word(Tag.IF, 'if'))
-    lx.reserve(Word(Tag.ELSE, 'else'))
-    ps = Parser(lx)
+    Only the function being parsed is held in memory. A Stats collects
+    the same counts as with parse(), timing just the parsing itself.
+    """
 
-    return ps.module()
+    if stats is None:
+        yield from Parser(make_lexer(stream)).functions()
+        return
 
+    with stats.phase('parse'):
+        lx = CountingLexer(make_lexer(stream), stats)
+        funcs = InstrumentedParser(lx, stats).functions()
+        func = next(funcs, None)
+    while func is not None:
+        stats.count_nodes(func)
+        yield func
+        with stats.phase('parse'):
+            func = next(funcs, None)
@@ -0,0 +1,862 @@
+"""
+AST optimizations.
+"""
+
+from collections import Counter
+from contextlib import nullcontext
+
+from tree import *
+
+MASK = 0xFFFFFFFF  # expressions are evaluated in eax
+INLINE_BUDGET = 16  # nodes in an inlined callee expression
+EVAL_STEPS = 100000  # evaluation steps per call evaluated at compile time
+EVAL_DEPTH = 256  # calls nested in one
+
+
+def is_const(node):
+    """Determines whether a node is a numeric Constant."""
+
+    return (isinstance(node, Constant)
+            and isinstance(node.value, (int, float)))
+
+
+# attributes holding the child nodes (or lists of them) of each node class
+CHILDREN = {
+    Module: ('body',),
+    FunctionDef: ('body',),
+    Assign: ('expression',),
+    Return: ('value',),
+    Bin_Op: ('left', 'right'),
+    Unary_Op: ('target',),
+    Ternary: ('condition', 'true_con', 'false_con'),
+    CallFunc: ('args',),
+    TailCall: ('args',),
+}
+
+
+def children(node):
+    """Returns the child nodes of node."""
+
+    result = []
+    for name in CHILDREN.get(type(node), ()):
+        value = getattr(node, name)
+        if isinstance(value, list):
+            result.extend(value)
+        else:
+            result.append(value)
+    return result
+
+
+def walk_nodes(node):
+    """Yields node and everything under it, parents first."""
+
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(children(node))
+
+
+def count_nodes(node):
+    """Returns the number of AST nodes under (and including) node."""
+
+    return sum(1 for _ in walk_nodes(node))
+
+
+def compute(op, a, b):
+    """Returns a <op> b as the generated code computes it, None if it faults."""
+
+    if op == '+':
+        return (a + b) & MASK
+    if op == '-':
+        return (a - b) & MASK
+    if op == '*':
+        return (a * b) & MASK
+    if op == '%' and b != 0:
+        return a % b
+    return None
+
+
+def fold_bin_op(node):
+    """Folds a Bin_Op whose children are already folded."""
+
+    left, right, op = node.left, node.right, node.operation
+    if is_const(left) and is_const(right):
+        value = compute(op, int(left.value) & MASK, int(right.value) & MASK)
+        return node if value is None else Constant(value)
+
+    if is_const(right):
+        b = int(right.value) & MASK
+        if b == 0 and op in '+-':
+            return left
+        if b == 1 and op == '*':
+            return left
+        if (b == 0 and op == '*' or b == 1 and op == '%') and not may_fault(left):
+            return Constant(0)
+    if is_const(left):
+        a = int(left.value) & MASK
+        if a == 0 and op == '+' or a == 1 and op == '*':
+            return right
+        if a == 0 and op == '*' and not may_fault(right):
+            return Constant(0)  # 0 % x still divides by zero when x is 0
+    return node
+
+
+def fold_node(node):
+    """Folds a node whose children are already folded."""
+
+    if isinstance(node, Bin_Op):
+        return fold_bin_op(node)
+    if isinstance(node, Unary_Op):
+        if node.operation == 'not' and is_const(node.target):
+            return Constant(0 if int(node.target.value) & MASK else 1)
+        return node
+    if isinstance(node, Ternary):
+        if is_const(node.condition):
+            return node.true_con if int(node.condition.value) & MASK else node.false_con
+        return node
+    return node
+
+
+def transform(node, rewrite):
+    """Replaces every node under node by rewrite(node), bottom-up.
+
+    rewrite sees a node after all its children were rewritten. Works from
+    an explicit stack: each entry is a node, where the reference to it is
+    stored (a list and index, or a parent and attribute name) and whether
+    its children are done. Returns the rewritten node.
+    """
+
+    root = [node]
+    stack = [(node, root, 0, False)]
+    while stack:
+        node, holder, key, done = stack.pop()
+        if done:
+            new = rewrite(node)
+            if new is not node:
+                if isinstance(holder, list):
+                    holder[key] = new
+                else:
+                    setattr(holder, key, new)
+            continue
+        stack.append((node, holder, key, True))
+        for name in CHILDREN.get(type(node), ()):
+            value = getattr(node, name)
+            if isinstance(value, list):
+                stack.extend((child, value, i, False) for i, child in enumerate(value))
+            else:
+                stack.append((value, node, name, False))
+    return root[0]
+
+
+def fold(node):
+    """Returns node with constant subexpressions evaluated."""
+
+    return transform(node, fold_node)
+
+
+def substitute(node, env, limit):
+    """Copies an expression, replacing each Id by a copy of env[id].
+
+    With env None Ids are copied as they are. Returns (copy, size), or None
+    when the copy would exceed limit nodes or node uses a variable missing
+    from env.
+    """
+
+    values = []
+    size = 0
+    stack = [(node, False)]
+    while stack:
+        node, done = stack.pop()
+        if isinstance(node, Id):
+            if env is None:
+                values.append(Id(node.id))
+                size += 1
+            elif node.id in env:
+                copied = substitute(env[node.id], None, limit - size)
+                if copied is None:
+                    return None
+                values.append(copied[0])
+                size += copied[1]
+            else:
+                return None
+        elif isinstance(node, Constant):
+            values.append(Constant(node.value))
+            size += 1
+        elif type(node) not in (Bin_Op, Unary_Op, Ternary, CallFunc):
+            return None
+        elif not done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children(node)))
+            continue
+        elif isinstance(node, Bin_Op):
+            right = values.pop()
+            values.append(Bin_Op(values.pop(), right, node.operation))
+            size += 1
+        elif isinstance(node, Unary_Op):
+            values.append(Unary_Op(values.pop(), node.operation))
+            size += 1
+        elif isinstance(node, Ternary):
+            false_con, true_con = values.pop(), values.pop()
+            values.append(Ternary(true_con, false_con, values.pop()))
+            size += 1
+        else:
+            args = values[len(values) - len(node.args):]
+            del values[len(values) - len(node.args):]
+            values.append(CallFunc(node.name, args))
+            size += 1
+        if size > limit:
+            return None
+    return values[0], size
+
+
+def inline_template(func, budget):
+    """Returns what func returns as one expression over its parameters.
+
+    Assignments are substituted into the Return that follows them, so the
+    callee's locals (and parameters it reassigns) become subexpressions
+    and never touch the caller's frame. Returns the expression and the
+    parameters it always evaluates; None if func has no Return, uses an
+    unassigned variable, drops or only conditionally evaluates an
+    assignment that may fault, or the expression exceeds budget nodes.
+    """
+
+    env = {param: Id(param) for param in func.args}
+    for i, stmt in enumerate(func.body):
+        if isinstance(stmt, Return):
+            result = substitute(stmt.value, env, budget)
+            if result is None:
+                return None
+            needed = strict_reads(stmt.value)
+            for prev in reversed(func.body[:i]):
+                if prev.id in needed:
+                    needed.discard(prev.id)
+                    needed |= strict_reads(prev.expression)
+                elif may_fault(prev.expression):
+                    return None
+            return result[0], needed
+        if not isinstance(stmt, Assign):
+            return None
+        result = substitute(stmt.expression, env, budget)
+        if result is None:
+            return None
+        env[stmt.id] = result[0]
+    return None
+
+
+def inline_calls(tree, budget=INLINE_BUDGET):
+    """Replaces calls of small functions by the expression they return.
+
+    Arguments are substituted for the parameters; one used more than once
+    must be a variable or a constant, so no call or arithmetic is repeated,
+    and one that may fault must be always evaluated by the callee.
+    Recursive functions are not inlined into themselves. Returns the
+    inlined call sites as (caller, callee, n) for the n-th call of callee
+    in caller.
+    """
+
+    funcs = {}
+    for func in tree.body:
+        key = (func.name, len(func.args))
+        funcs[key] = None if key in funcs else func  # ambiguous if defined twice
+    templates = {}
+    for key, func in funcs.items():
+        found = inline_template(func, budget) if func is not None else None
+        if found is not None:
+            template, strict = found
+            uses = {}
+            for node in walk_nodes(template):
+                if isinstance(node, Id):
+                    uses[node.id] = uses.get(node.id, 0) + 1
+            templates[key] = (func.args, template, uses, strict)
+
+    sites = []
+    for func in tree.body:
+        seen = {}
+
+        def inline(node):
+            if not isinstance(node, CallFunc):
+                return node
+            seen[node.name] = seen.get(node.name, 0) + 1
+            found = templates.get((node.name, len(node.args)))
+            if found is None or node.name == func.name:
+                return node
+            params, template, uses, strict = found
+            env = dict(zip(params, node.args))
+            for param, arg in env.items():
+                if uses.get(param, 0) > 1 and not isinstance(arg, (Id, Constant)):
+                    return node
+                if param not in strict and may_fault(arg):
+                    return node
+            sites.append((func.name, node.name, seen[node.name]))
+            return instantiate(template, env)
+
+        count = len(sites)
+        transform(func, inline)
+        if len(sites) != count:
+            func.source = None
+    return sites
+
+
+def instantiate(template, env):
+    """Copies a template, putting the arguments in env at its parameters."""
+
+    placed = set()
+
+    def put(node):
+        if not isinstance(node, Id):
+            return node
+        if node.id in placed:
+            return substitute(env[node.id], None, 1)[0]  # a variable or constant
+        placed.add(node.id)
+        return env[node.id]
+
+    return transform(substitute(template, None, count_nodes(template))[0], put)
+
+
+def eliminate_tail_calls(tree):
+    """Turns calls of a function to itself whose value it returns into jumps.
+
+    A call is in tail position as a Return's value or, recursively, as
+    either arm of a Ternary there. Such calls become TailCalls and the
+    function gets a Label to jump to. Returns the number of calls turned
+    into jumps per function.
+    """
+
+    report = {}
+    for func in tree.body:
+        count = 0
+        for stmt in func.body:
+            if not isinstance(stmt, Return):
+                continue
+            stack = [(stmt, 'value')]
+            while stack:
+                holder, name = stack.pop()
+                node = getattr(holder, name)
+                if isinstance(node, Ternary):
+                    stack.append((node, 'true_con'))
+                    stack.append((node, 'false_con'))
+                elif (type(node) is CallFunc and node.name == func.name
+                      and len(node.args) == len(func.args)):
+                    setattr(holder, name, TailCall(node.name, node.args))
+                    count += 1
+        if count:
+            func.body.insert(0, Label(func.name))
+            func.source = None
+            report[func.name] = count
+    return report
+
+
+class NotConstant(Exception):
+    """A call cannot be evaluated at compile time."""
+
+
+class Evaluator:
+    """Runs calls of a module's functions at compile time.
+
+    Functions only compute a value from their arguments, so a call with
+    constant arguments can be replaced by its result. A call gives up,
+    returning None, when it needs more than steps evaluation steps or
+    calls nested deeper than depth, or when the generated code would not
+    produce a value: division by zero, an unknown variable, no Return.
+    Results (and failures) are kept in memo by name and arguments.
+    """
+
+    def __init__(self, tree, steps=EVAL_STEPS, depth=EVAL_DEPTH):
+        self.funcs = {}
+        for func in tree.body:
+            key = (func.name, len(func.args))
+            self.funcs[key] = None if key in self.funcs else func  # ambiguous if defined twice
+        self.steps = steps
+        self.depth = depth
+        self.memo = {}
+
+    def call(self, name, args):
+        """Returns the value of name(*args), None if it cannot be computed."""
+
+        key = (name, tuple(args))
+        if key not in self.memo:
+            try:
+                self.memo[key] = self.run(name, args)
+            except NotConstant:
+                self.memo[key] = None
+        return self.memo[key]
+
+    def run(self, name, args):
+        """Evaluates a call from an explicit stack of tasks.
+
+        A task is a tuple naming what to do; operands are taken from and
+        results left on a stack of values.
+        """
+
+        values = list(args)
+        tasks = [('call', name, len(args), 0)]
+        steps = self.steps
+        while tasks:
+            steps -= 1
+            if steps < 0:
+                raise NotConstant(name)
+            task = tasks.pop()
+            kind = task[0]
+            if kind == 'eval':
+                _, node, env, depth = task
+                if isinstance(node, Constant) and is_const(node):
+                    values.append(int(node.value) & MASK)
+                elif isinstance(node, Id) and node.id in env:
+                    values.append(env[node.id])
+                elif isinstance(node, Bin_Op):
+                    tasks.append(('op', node.operation))
+                    tasks.append(('eval', node.right, env, depth))
+                    tasks.append(('eval', node.left, env, depth))
+                elif isinstance(node, Unary_Op) and node.operation == 'not':
+                    tasks.append(('not',))
+                    tasks.append(('eval', node.target, env, depth))
+                elif isinstance(node, Ternary):
+                    tasks.append(('ternary', node, env, depth))
+                    tasks.append(('eval', node.condition, env, depth))
+                elif isinstance(node, (CallFunc, TailCall)):
+                    tasks.append(('call', node.name, len(node.args), depth))
+                    tasks.extend(('eval', arg, env, depth) for arg in reversed(node.args))
+                else:
+                    raise NotConstant(name)
+            elif kind == 'op':
+                b, a = values.pop(), values.pop()
+                value = compute(task[1], a, b)
+                if value is None:
+                    raise NotConstant(name)
+                values.append(value)
+            elif kind == 'not':
+                values.append(0 if values.pop() else 1)
+            elif kind == 'ternary':
+                _, node, env, depth = task
+                arm = node.true_con if values.pop() else node.false_con
+                tasks.append(('eval', arm, env, depth))
+            elif kind == 'call':
+                _, callee, count, depth = task
+                args = tuple(values[len(values) - count:])
+                del values[len(values) - count:]
+                key = (callee, args)
+                if key in self.memo:
+                    if self.memo[key] is None:
+                        raise NotConstant(name)
+                    values.append(self.memo[key])
+                    continue
+                func = self.funcs.get((callee, count))
+                if func is None or depth >= self.depth:
+                    raise NotConstant(name)
+                tasks.append(('memo', key))
+                tasks.append(('stmt', func, 0, dict(zip(func.args, args)), depth + 1))
+            elif kind == 'stmt':
+                _, func, i, env, depth = task
+                if i >= len(func.body):
+                    raise NotConstant(name)
+                stmt = func.body[i]
+                if isinstance(stmt, Return):
+                    tasks.append(('eval', stmt.value, env, depth))
+                elif isinstance(stmt, Assign):
+                    tasks.append(('stmt', func, i + 1, env, depth))
+                    tasks.append(('assign', stmt.id, env))
+                    tasks.append(('eval', stmt.expression, env, depth))
+                elif isinstance(stmt, Label):
+                    tasks.append(('stmt', func, i + 1, env, depth))
+                else:
+                    raise NotConstant(name)
+            elif kind == 'assign':
+                task[2][task[1]] = values.pop()
+            else:
+                self.memo[task[1]] = values[-1]
+        return values.pop()
+
+
+def evaluate_calls(tree, steps=EVAL_STEPS, depth=EVAL_DEPTH):
+    """Replaces calls with compile-time constant arguments by their value.
+
+    Arguments count as constant when they are computed from constants and
+    from local variables last assigned such a value; statements run in
+    order, so tracking these is exact. Returns the number of calls replaced.
+    """
+
+    evaluator = Evaluator(tree, steps, depth)
+    replaced = 0
+    for func in tree.body:
+        count = 0
+        env = {}  # locals holding a known value
+
+        def rewrite(node):
+            nonlocal count
+            value = None
+            if isinstance(node, Constant) and is_const(node):
+                value = int(node.value) & MASK
+            elif isinstance(node, Id):
+                value = env.get(node.id)
+            elif isinstance(node, Bin_Op):
+                a, b = known.get(id(node.left)), known.get(id(node.right))
+                if a is not None and b is not None:
+                    value = compute(node.operation, a, b)
+            elif isinstance(node, Unary_Op):
+                a = known.get(id(node.target))
+                if a is not None and node.operation == 'not':
+                    value = 0 if a else 1
+            elif isinstance(node, Ternary):
+                a = known.get(id(node.condition))
+                if a is not None:
+                    value = known.get(id(node.true_con if a else node.false_con))
+            elif isinstance(node, CallFunc):
+                args = [known.get(id(arg)) for arg in node.args]
+                if None not in args:
+                    value = evaluator.call(node.name, args)
+                    if value is not None:
+                        node = Constant(value)
+                        count += 1
+            known[id(node)] = value
+            return node
+
+        for stmt in func.body:
+            known = {}  # value of each node of the statement, None if unknown
+            if isinstance(stmt, Assign):
+                stmt.expression = transform(stmt.expression, rewrite)
+                value = known[id(stmt.expression)]
+                if value is None:
+                    env.pop(stmt.id, None)
+                else:
+                    env[stmt.id] = value
+            elif isinstance(stmt, Return):
+                stmt.value = transform(stmt.value, rewrite)
+        if count:
+            func.source = None
+            replaced += count
+    return replaced
+
+
+def fold_constants(tree):
+    """Folds constants in tree in place, returns the number of nodes removed."""
+
+    removed = 0
+    for func in tree.body:
+        before = count_nodes(func)
+        fold(func)
+        if count_nodes(func) != before:
+            func.source = None
+            removed += before - count_nodes(func)
+    return removed
+
+
+def drop_unreachable(tree):
+    """Drops the statements after the first Return of each function, which
+    never run. Returns the number of statements dropped."""
+
+    dropped = 0
+    for func in tree.body:
+        for num, stmt in enumerate(func.body):
+            if isinstance(stmt, Return):
+                if num + 1 < len(func.body):
+                    dropped += len(func.body) - num - 1
+                    del func.body[num + 1:]
+                    func.source = None
+                break
+    return dropped
+
+
+def may_fault(node):
+    """Determines whether evaluating a node may not end: a call may recurse
+    without end and % may divide by zero."""
+
+    for node in walk_nodes(node):
+        if isinstance(node, (CallFunc, TailCall)):
+            return True
+        if (isinstance(node, Bin_Op) and node.operation == '%'
+                and not (is_const(node.right) and int(node.right.value) & MASK)):
+            return True
+    return False
+
+
+def reads(node):
+    """Returns the names of the variables an expression reads."""
+
+    return {node.id for node in walk_nodes(node) if isinstance(node, Id)}
+
+
+def strict_reads(node):
+    """Returns the names of the variables an expression reads whatever the
+    outcome of its conditions: those outside the arms of a Ternary."""
+
+    names = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Id):
+            names.add(node.id)
+        elif isinstance(node, Ternary):
+            stack.append(node.condition)
+        else:
+            stack.extend(children(node))
+    return names
+
+
+def put_child(holder, key, node):
+    """Stores node where a child is referenced from: a list and index, or a
+    parent and attribute name."""
+
+    if isinstance(holder, list):
+        holder[key] = node
+    else:
+        setattr(holder, key, node)
+
+
+class ValueNumbering:
+    """Numbers the values computed by the statements of one function.
+
+    Nodes get the same number when they compute the same value: equal
+    constants, the same operation on the same numbers, or a call of the
+    same function on the same numbers, as functions have no side effects.
+    + and * take their operands in either order. A variable read gets the
+    number of the value last assigned to it; statements run in order, so
+    this is exact. numbers maps id(node) -> number.
+    """
+
+    def __init__(self, func):
+        self.keys = {}  # key -> number
+        self.numbers = {}
+        self.variables = {name: self.number(('param', name)) for name in func.args}
+        for stmt in func.body:
+            if isinstance(stmt, Assign):
+                self.variables[stmt.id] = self.visit(stmt.expression)
+            elif isinstance(stmt, Return):
+                self.visit(stmt.value)
+
+    def number(self, key):
+        return self.keys.setdefault(key, len(self.keys))
+
+    def visit(self, node):
+        """Numbers node and the nodes under it, returns its number."""
+
+        numbers = self.numbers
+        for child in reversed(list(walk_nodes(node))):  # children first
+            if isinstance(child, Id):
+                if child.id in self.variables:
+                    numbers[id(child)] = self.variables[child.id]
+                    continue
+                key = ('unknown', child.id)
+            elif isinstance(child, Constant):
+                key = ('const', int(child.value) & MASK) if is_const(child) else ('literal', child.literal())
+            elif isinstance(child, Bin_Op):
+                a, b = numbers[id(child.left)], numbers[id(child.right)]
+                if child.operation in '+*' and a > b:
+                    a, b = b, a
+                key = (child.operation, a, b)
+            elif isinstance(child, CallFunc):
+                key = ('call', child.name) + tuple(numbers[id(arg)] for arg in child.args)
+            elif isinstance(child, (Unary_Op, Ternary)):
+                key = (type(child).__name__,) + tuple(numbers[id(arg)] for arg in children(child))
+            else:
+                key = ('unique', len(self.keys))  # a TailCall does not come back
+            numbers[id(child)] = self.number(key)
+        return numbers[id(node)]
+
+
+def eliminate_common_subexpressions(tree):
+    """Computes each value once per function.
+
+    A subexpression whose value a variable holds is replaced by the
+    variable. One whose value is computed in several places, unless it is
+    the whole value of an Assign, is computed into a new local before the
+    first statement needing it; these are named cse<n>, which no source
+    identifier can be. That takes subexpressions out of Ternary arms, so
+    ones that may fault are only taken from where they are always
+    evaluated. Returns the number of subexpressions replaced.
+    """
+
+    replaced = 0
+    for func in tree.body:
+        numbers = ValueNumbering(func).numbers
+        counts = Counter()  # number -> nodes computing it
+        for stmt in func.body:
+            for node in walk_nodes(stmt):
+                if isinstance(node, (Bin_Op, Unary_Op, Ternary, CallFunc)):
+                    counts[numbers[id(node)]] += 1
+
+        def discount(node, times):
+            """Accounts for the nodes under node computed times less."""
+
+            for inner in walk_nodes(node):
+                if inner is not node and id(inner) in numbers:
+                    counts[numbers[id(inner)]] -= times
+
+        count = temps = 0
+        held = {}  # number -> a variable holding it
+        variables = {}  # variable -> number of the value it holds
+        body = []
+        for stmt in func.body:
+            if not isinstance(stmt, (Assign, Return)):
+                body.append(stmt)
+                continue
+            key = 'expression' if isinstance(stmt, Assign) else 'value'
+            result = numbers[id(getattr(stmt, key))]
+            # tasks: ('expr', node, holder, key, in a Ternary arm)
+            # or ('hoist', local, node, number), once the node is rewritten
+            stack = [('expr', getattr(stmt, key), stmt, key, False)]
+            while stack:
+                task = stack.pop()
+                if task[0] == 'hoist':
+                    _, name, node, number = task
+                    body.append(Assign(name, node))
+                    held[number] = name
+                    continue
+                _, node, holder, key, conditional = task
+                if isinstance(node, (Constant, Id)):
+                    continue
+                number = numbers[id(node)]
+                if number in held:
+                    put_child(holder, key, Id(held[number]))
+                    count += 1
+                    continue
+                if counts[number] > 1:
+                    if holder is stmt:
+                        if isinstance(stmt, Assign):
+                            discount(node, counts[number] - 1)
+                    elif not conditional or not may_fault(node):
+                        temps += 1
+                        name = f'cse{temps}'
+                        discount(node, counts[number] - 1)
+                        put_child(holder, key, Id(name))
+                        stack.append(('hoist', name, node, number))
+                        conditional = False
+                for name in reversed(CHILDREN[type(node)]):
+                    child = getattr(node, name)
+                    if isinstance(child, list):
+                        stack.extend(('expr', arg, child, num, conditional)
+                                     for num, arg in reversed(list(enumerate(child))))
+                    else:
+                        arm = conditional or name in ('true_con', 'false_con')
+                        stack.append(('expr', child, node, name, arm))
+            body.append(stmt)
+            if isinstance(stmt, Assign):
+                if held.get(variables.get(stmt.id)) == stmt.id:
+                    del held[variables[stmt.id]]
+                variables[stmt.id] = result
+                held.setdefault(result, stmt.id)
+        if count or temps:
+            func.body = body
+            func.source = None
+            replaced += count
+    return replaced
+
+
+def eliminate_dead_stores(tree):
+    """Drops assignments of values not read before the variable is assigned
+    again or the function returns, unless computing the value may fault
+    (see may_fault()), which must still happen. Locals only assigned that
+    way go with them. Returns the number of assignments dropped.
+    """
+
+    dropped = 0
+    for func in tree.body:
+        live = set()  # variables read before being assigned again
+        body = []
+        for stmt in reversed(func.body):
+            if isinstance(stmt, Assign):
+                if stmt.id not in live and not may_fault(stmt.expression):
+                    dropped += 1
+                    func.source = None
+                    continue
+                live.discard(stmt.id)
+                live |= reads(stmt.expression)
+            elif isinstance(stmt, Return):
+                live = reads(stmt.value)
+            body.append(stmt)
+        body.reverse()
+        func.body = body
+    return dropped
+
+
+def call_graph(tree):
+    """Maps each function, as (name, arity), to the list of the functions
+    it calls."""
+
+    graph = {}
+    for func in tree.body:
+        callees = graph.setdefault((func.name, len(func.args)), {})
+        for node in walk_nodes(func):
+            if isinstance(node, (CallFunc, TailCall)):
+                callees[node.name, len(node.args)] = None
+    return {key: list(callees) for key, callees in graph.items()}
+
+
+def eliminate_dead_functions(tree):
+    """Drops the functions that no chain of calls from main reaches.
+
+    Returns the names of those dropped, in the order they were defined.
+    A module without main, which generate() rejects, is left alone.
+    """
+
+    graph = call_graph(tree)
+    stack = [key for key in graph if key[0] == 'main']
+    if not stack:
+        return []
+    reached = set(stack)
+    while stack:
+        for callee in graph.get(stack.pop(), ()):
+            if callee not in reached:
+                reached.add(callee)
+                stack.append(callee)
+    dropped = [func.name for func in tree.body if (func.name, len(func.args)) not in reached]
+    if dropped:
+        tree.body = [func for func in tree.body if (func.name, len(func.args)) in reached]
+    return dropped
+
+
+def optimize(tree, fold=True, inline=0, tailcalls=False, evaluate=False, cse=False,
+             dead_stores=False, dead_functions=False):
+    """Runs the enabled passes over tree in place.
+
+    inline is the node budget of inlined functions, 0 disables inlining.
+    Returns a report mapping each pass that ran to what it did: the number
+    of AST nodes it removed, the list of call sites inlined, the calls
+    evaluated at compile time, the statements dropped after a Return, the
+    subexpressions replaced by a variable, the assignments dropped, the
+    functions unreachable from main dropped or the tail calls turned into
+    jumps per function.
+    """
+
+    report = {}
+    if inline:
+        report['inline'] = inline_calls(tree, inline)
+    if evaluate:
+        report['evaluate'] = evaluate_calls(tree)
+    if fold:
+        report['fold'] = fold_constants(tree)
+    if cse or dead_stores:
+        report['unreachable'] = drop_unreachable(tree)
+    if cse:
+        report['cse'] = eliminate_common_subexpressions(tree)
+    if dead_stores:
+        report['dead_stores'] = eliminate_dead_stores(tree)
+    if dead_functions:
+        report['dead_functions'] = eliminate_dead_functions(tree)
+    if tailcalls:
+        report['tailcalls'] = eliminate_tail_calls(tree)
+    return report
+
+
+def optimize_stream(funcs, fold=True, tailcalls=False, cse=False, dead_stores=False,
+                    stats=None):
+    """Runs the passes that look at one function at a time over FunctionDefs
+    as they are yielded, yielding each when done.
+
+    Inlining, call evaluation and dropping dead functions need the whole
+    module and are not available. The report optimize() would return is accumulated in
+    stats.passes when a Stats is given.
+    """
+
+    for func in funcs:
+        with stats.phase('optimize') if stats else nullcontext():
+            report = optimize(Module([func]), fold=fold, tailcalls=tailcalls, cse=cse,
+                              dead_stores=dead_stores)
+        if stats:
+            passes = stats.passes
+            for name, done in report.items():
+                if isinstance(done, dict):
+                    passes.setdefault(name, {}).update(done)
+                else:
+                    passes[name] = passes.get(name, 0) + done
+        yield func
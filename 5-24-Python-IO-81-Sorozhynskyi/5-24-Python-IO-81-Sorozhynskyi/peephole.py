@@ -0,0 +1,255 @@
+"""
+Peephole optimizer for generated MASM32 code.
+"""
+
+import re
+
+REGISTERS = ('eax', 'ebx', 'ecx', 'edx', 'esi', 'edi')
+SUB_REGISTERS = {'al': 'eax', 'ah': 'eax', 'ax': 'eax', 'bl': 'ebx', 'bh': 'ebx', 'bx': 'ebx',
+                 'cl': 'ecx', 'ch': 'ecx', 'cx': 'ecx', 'dl': 'edx', 'dh': 'edx', 'dx': 'edx'}
+REGISTER_RE = re.compile(r'\b(e[abcd]x|e[sd]i|e[sb]p|[abcd][lhx])\b')
+ARITHMETIC = ('add', 'sub', 'and', 'or', 'xor', 'shl', 'shr', 'sar', 'imul')
+
+
+def registers(operand):
+    """Returns the 32-bit registers an operand mentions."""
+
+    return {SUB_REGISTERS.get(r, r) for r in REGISTER_RE.findall(operand)}
+
+
+def is_register(operand):
+    return operand in REGISTERS
+
+
+def is_memory(operand):
+    return '[' in operand
+
+
+class Instruction:
+    """One line of assembly: an opcode (or label, or directive) and operands."""
+
+    __slots__ = ('op', 'args')
+
+    def __init__(self, op, args=()):
+        self.op = op
+        self.args = list(args)
+
+    @classmethod
+    def parse(cls, line):
+        op, _, rest = line.strip().partition(' ')
+        if op.startswith('.') or not rest:
+            return cls(op, [rest] if rest else [])
+        return cls(op, [arg.strip() for arg in rest.split(',')])
+
+    def __str__(self):
+        if not self.args:
+            return self.op
+        return f'{self.op} {", ".join(self.args)}'
+
+    def __repr__(self):
+        return f'<{self}>'
+
+    def is_barrier(self):
+        """Labels, directives and jumps end straight-line code."""
+
+        return (self.op.startswith('.') or self.op.endswith(':')
+                or self.op.startswith('j')
+                or self.args[-1:] in (['PROC'], ['ENDP']))
+
+    def effects(self):
+        """Returns (registers read, registers written), None if unknown."""
+
+        op, args = self.op, self.args
+        if op in ('mov', 'movzx', 'lea'):
+            dst, src = args
+            read = registers(src)
+            if is_memory(dst):
+                return read | registers(dst), set()
+            return read, {dst}
+        if op == 'imul' and len(args) == 3:
+            return registers(args[1]), {args[0]}
+        if op in ARITHMETIC and len(args) == 2:
+            dst, src = args
+            if op in ('xor', 'sub') and dst == src:
+                return set(), {dst}
+            return registers(dst) | registers(src), {dst} if is_register(dst) else set()
+        if op in ('cmp', 'test'):
+            return registers(args[0]) | registers(args[1]), set()
+        if op in ('inc', 'dec', 'neg', 'not'):
+            return registers(args[0]), {args[0]} if is_register(args[0]) else set()
+        if op == 'mul':
+            return {'eax'} | registers(args[0]), {'eax', 'edx'}
+        if op == 'div':
+            return {'eax', 'edx'} | registers(args[0]), {'eax', 'edx'}
+        if op == 'push':
+            return registers(args[0]) | {'esp'}, {'esp'}
+        if op == 'pop':
+            if is_memory(args[0]):
+                return {'esp'} | registers(args[0]), {'esp'}
+            return {'esp'}, {args[0], 'esp'}
+        if op.startswith('set'):
+            reg = SUB_REGISTERS[args[0]]
+            return {reg}, {reg}
+        if op.startswith('cmov'):
+            return registers(args[0]) | registers(args[1]), {args[0]}
+        if op == 'call':
+            # fastcall arguments are in ecx, edx and ebx; callers save
+            # what they keep in registers, so the callee changes them all
+            return {'ecx', 'edx', 'ebx', 'esp'}, set(REGISTERS)
+        return None
+
+
+def is_dead(code, i, reg):
+    """Determines whether reg is overwritten before being read from code[i] on."""
+
+    for j in range(i, len(code)):  # a slice would copy the rest of code
+        ins = code[j]
+        if ins.op == 'ret':
+            return reg != 'eax'
+        if ins.is_barrier():
+            return False
+        effects = ins.effects()
+        if effects is None:
+            return False
+        read, written = effects
+        if reg in read:
+            return False
+        if reg in written:
+            return True
+    return False
+
+
+def push_pop(code, i):
+    """push A / pop B -> mov B, A (nothing when A is B)."""
+
+    if i + 1 < len(code) and code[i].op == 'push' and code[i + 1].op == 'pop':
+        src, dst = code[i].args[0], code[i + 1].args[0]
+        if src == dst:
+            return 2, []
+        if is_register(dst):
+            return 2, [Instruction('mov', [dst, src])]
+    return None
+
+
+def push_around(code, i):
+    """push R / X / pop R -> X, when X leaves R and the stack alone."""
+
+    if (i + 2 < len(code) and code[i].op == 'push' and code[i + 2].op == 'pop'
+            and code[i].args == code[i + 2].args and is_register(code[i].args[0])):
+        ins = code[i + 1]
+        if ins.is_barrier():
+            return None
+        effects = ins.effects()
+        reg = code[i].args[0]
+        if effects is not None and not ({reg, 'esp'} & (effects[0] | effects[1])):
+            return 3, [ins]
+    return None
+
+
+def dead_move(code, i):
+    """mov R, X whose R is overwritten before it is read -> nothing."""
+
+    ins = code[i]
+    if ins.op in ('mov', 'movzx', 'lea') or ins.op == 'xor' and ins.args[0] == ins.args[-1]:
+        reg = ins.args[0]
+        if is_register(reg) and is_dead(code, i + 1, reg):
+            return 1, []
+    return None
+
+
+def copy_forward(code, i):
+    """mov R, X / mov D, R -> mov D, X, when R is dead afterwards."""
+
+    if i + 1 < len(code) and code[i].op == 'mov' and code[i + 1].op == 'mov':
+        reg, src = code[i].args
+        dst, copy = code[i + 1].args
+        if (is_register(reg) and copy == reg and dst != reg
+                and not (is_memory(dst) and is_memory(src))
+                and is_dead(code, i + 2, reg)):
+            return 2, [Instruction('mov', [dst, src])]
+    return None
+
+
+def fold_operand(code, i):
+    """mov R, X / OP D, R -> OP D, X, when R is dead afterwards."""
+
+    if i + 1 < len(code) and code[i].op == 'mov':
+        reg, src = code[i].args
+        ins = code[i + 1]
+        if not is_register(reg) or registers(src) & {'esp'}:
+            return None
+        if (ins.op in ('add', 'sub', 'and', 'or', 'xor', 'cmp') and ins.args[1] == reg
+                and ins.args[0] != reg and not (is_memory(ins.args[0]) and is_memory(src))):
+            if is_dead(code, i + 2, reg):
+                return 2, [Instruction(ins.op, [ins.args[0], src])]
+        if ins.op in ('mul', 'div') and ins.args == [reg] and is_memory(src):
+            if is_dead(code, i + 2, reg):
+                return 2, [Instruction(ins.op, [src])]
+    return None
+
+
+def reload(code, i):
+    """mov M, R / mov R, M -> mov M, R."""
+
+    if i + 1 < len(code) and code[i].op == 'mov' and code[i + 1].op == 'mov':
+        dst, src = code[i].args
+        if is_memory(dst) and is_register(src) and code[i + 1].args == [src, dst]:
+            return 2, [code[i]]
+    return None
+
+
+def unreachable(code, i):
+    """Drops straight-line code following ret or jmp."""
+
+    if code[i].op in ('ret', 'jmp') and i + 1 < len(code) and not code[i + 1].is_barrier():
+        n = 1
+        while i + 1 + n < len(code) and not code[i + 1 + n].is_barrier():
+            n += 1
+        return 1 + n, [code[i]]
+    return None
+
+
+RULES = [push_pop, push_around, copy_forward, fold_operand, dead_move, reload, unreachable]
+
+
+class Peephole:
+    """Rewrites instruction lists with a set of rules until none applies.
+
+    A rule is a function taking the instruction list and a position; it
+    returns None, or the number of instructions it consumed there and
+    their replacement. hits counts successful applications per rule.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = list(RULES if rules is None else rules)
+        self.hits = {rule.__name__: 0 for rule in self.rules}
+
+    def run(self, code):
+        """Optimizes a list of Instructions, returns the new list."""
+
+        changed = True
+        while changed:
+            changed = False
+            result = []
+            i = 0
+            while i < len(code):
+                for rule in self.rules:
+                    match = rule(code, i)
+                    if match is not None:
+                        consumed, replacement = match
+                        self.hits[rule.__name__] += 1
+                        result.extend(replacement)
+                        i += consumed
+                        changed = True
+                        break
+                else:
+                    result.append(code[i])
+                    i += 1
+            code = result
+        return code
+
+    def run_text(self, text):
+        """Optimizes assembly text, one instruction per line."""
+
+        code = [Instruction.parse(line) for line in text.split('\n') if line.strip()]
+        return '\n' + '\n'.join(str(ins) for ins in self.run(code))
@@ -0,0 +1,154 @@
+"""
+Compile server.
+
+Keeps the compiler loaded in one long-running process that compiles
+source text sent over a Unix socket, so a compile pays neither
+interpreter startup nor imports. A connection carries any number of
+requests, one JSON object per line:
+
+    {"source": "def main():\\n    return 1\\n", "options": {"regalloc": true}}
+
+and gets one JSON line back for each, in order:
+
+    {"asm": "...", "error": null, "seconds": 0.0004}
+
+Every request builds its own lexer, parser, symbol table, frames and
+peephole optimizer, so requests share nothing but the code cache and
+are served concurrently, one thread per connection.
+"""
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import time
+
+from myparser import parse
+from emitter import CodegenOptions
+from generator import generate
+from optimizer import optimize
+from peephole import Peephole
+from cache import FunctionCache
+from instrument import Stats
+
+OPTIONS = ('fold', 'peephole', 'inline', 'tailcalls', 'evaluate', 'ir', 'cse', 'dead_stores',
+           'dead_functions', 'stats') + CodegenOptions._fields
+
+
+def compile_source(code, cache=None, fold=True, codegen=CodegenOptions(), peephole=False,
+                   inline=0, tailcalls=False, evaluate=False, ir=False, cse=False,
+                   dead_stores=False, dead_functions=False, stats=False):
+    """Compiles source text; returns the assembly and the stats dict or None."""
+
+    report = Stats() if stats else None
+    tree = parse(code, stats=report)
+    if report is None:
+        optimize(tree, fold=fold, inline=inline, tailcalls=tailcalls, evaluate=evaluate, cse=cse,
+                 dead_stores=dead_stores, dead_functions=dead_functions)
+    else:
+        with report.phase('optimize'):
+            report.passes = optimize(tree, fold=fold, inline=inline, tailcalls=tailcalls,
+                                     evaluate=evaluate, cse=cse, dead_stores=dead_stores,
+                                     dead_functions=dead_functions)
+    peephole = Peephole() if peephole else None
+    asm = generate(tree, codegen=codegen, peephole=peephole, cache=cache, stats=report, ir=ir)
+    if report is not None:
+        report.peephole = peephole and dict(peephole.hits)
+        report.cache = cache and cache.stats()
+    return asm, report and report.as_dict()
+
+
+class CompileHandler(socketserver.StreamRequestHandler):
+    """Answers the requests of one connection until the client closes it."""
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                response = self.server.respond(line)
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class CompileServer(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server compiling requests with a shared FunctionCache."""
+
+    daemon_threads = True
+
+    def __init__(self, path, cache_dir=None):
+        self.cache = FunctionCache(cache_dir) if cache_dir else None
+        super().__init__(path, CompileHandler)
+
+    def respond(self, line):
+        """Returns the response to one request line."""
+
+        start = time.perf_counter()
+        try:
+            request = json.loads(line)
+            options = dict(request.get('options', {}))
+            unknown = sorted(set(options) - set(OPTIONS))
+            if unknown:
+                raise ValueError(f'unknown options: {", ".join(unknown)}')
+            codegen = CodegenOptions(**{name: options.pop(name)
+                                        for name in CodegenOptions._fields if name in options})
+            asm, stats = compile_source(request['source'], self.cache, codegen=codegen, **options)
+        except Exception as err:
+            return {'asm': None, 'error': f'{type(err).__name__}: {err}',
+                    'seconds': time.perf_counter() - start}
+        response = {'asm': asm, 'error': None, 'seconds': time.perf_counter() - start}
+        if stats is not None:
+            response['stats'] = stats
+        return response
+
+
+class Client:
+    """Connection to a compile server.
+
+    compile() sends one request and waits for its response dict; the
+    connection is reused for the following ones.
+    """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rwb')
+
+    def compile(self, source, **options):
+        request = json.dumps({'source': source, 'options': options})
+        self.file.write(request.encode() + b'\n')
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Serves compiles over a Unix socket.')
+    ap.add_argument('socket', help='path of the socket to listen on')
+    ap.add_argument('--cache', metavar='DIR', help='per-function code cache directory')
+    args = ap.parse_args(argv)
+
+    if os.path.exists(args.socket) and stat.S_ISSOCK(os.stat(args.socket).st_mode):
+        os.remove(args.socket)  # left over by a server that was killed
+    with CompileServer(args.socket, args.cache) as server:
+        print(f'listening on {args.socket}', flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,8 @@
+import pytest
+
+from myparser import parse
+
+
+def test_non_ascii_digit_is_illegal():
+    with pytest.raises(SyntaxError, match='illegal character'):
+        parse('def main():\n    return ٣\n')
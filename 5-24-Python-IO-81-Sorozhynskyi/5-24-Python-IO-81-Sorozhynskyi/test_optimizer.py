@@ -0,0 +1,37 @@
+from myparser import parse
+from optimizer import Evaluator, inline_calls
+
+UNUSED_ARGUMENT = '''def h(a, c):
+    return a
+
+def main():
+    b = 0
+    return h(b, 1 % b)
+'''
+
+UNUSED_LOCAL = '''def h(a, c):
+    e = a % c
+    return a
+
+def main():
+    b = 0
+    return h(b, b)
+'''
+
+
+def test_inlining_keeps_unused_faulting_argument():
+    tree = parse(UNUSED_ARGUMENT)
+    assert inline_calls(tree) == []
+    assert Evaluator(tree).call('main', []) is None
+
+
+def test_inlining_keeps_unused_faulting_local():
+    tree = parse(UNUSED_LOCAL)
+    assert inline_calls(tree) == []
+    assert Evaluator(tree).call('main', []) is None
+
+
+def test_inlining_drops_unused_argument_that_cannot_fault():
+    tree = parse(UNUSED_ARGUMENT.replace('1 % b', 'b * 2'))
+    assert inline_calls(tree) == [('main', 'h', 1)]
+    assert Evaluator(tree).call('main', []) == 0
@@ -1,14 +1,381 @@
-from collections import ChainMap
-
-var_map = ChainMap()
-shift = -4
-
 """
 AST Classes.
 """
 
+from collections import Counter
+
+# registers handed out to subexpressions in register allocating mode;
+# eax and edx stay free as scratch for mul/div
+REGISTERS = ['ebx', 'ecx', 'esi', 'edi']
+# registers the most used locals are kept in with hot_locals; stack code
+# never touches them, register allocation leaves out the ones in use and
+# callers save them around calls
+HOME_REGISTERS = ['edi', 'esi']
+# with branchless set, a ternary whose arms have at most this many nodes
+# together evaluates both and picks one with cmov: cheaper than the
+# mispredicted jump it replaces
+BRANCH_COST = 8
+# with fastcall set, functions but main taking at most this many arguments
+# get them in these registers, in order, instead of on the stack
+FAST_REGISTERS = ['ecx', 'edx', 'ebx']
+# a fastcall function calling none keeps its variables in these instead of
+# a frame when they fit; ebp is saved first if used
+LEAF_REGISTERS = ['edi', 'esi', 'ebp']
+
+
+class Frame:
+    """Code generation state of one function: where its variables live.
+
+    The layout is fixed before any code is generated. Every local gets a
+    slot below ebp in the order it is first assigned, reserved at once by
+    the prologue; with hot set the most read locals get a register from
+    HOME_REGISTERS instead. With fastcall set the arguments come in
+    FAST_REGISTERS and are stored like locals, first; if the function
+    calls none and its variables fit in LEAF_REGISTERS, they all live
+    there and there is no frame. A variable may only be read once its
+    assignment has been generated, as tracked in assigned.
+    """
+
+    __slots__ = ('args', 'offsets', 'registers', 'assigned', 'size', 'pool', 'frameless')
+
+    def __init__(self, args, body=(), hot=False, fastcall=False):
+        self.args = args
+        self.offsets = {} if fastcall else {param: num*4 + 8 for num, param in enumerate(args)}
+        self.registers = {}  # local -> home register
+        self.assigned = set(args)
+        self.frameless = False
+        names = list(args) if fastcall else []
+        for node in body:
+            if isinstance(node, Assign) and node.id not in self.offsets and node.id not in names:
+                names.append(node.id)
+        if fastcall and len(names) <= len(LEAF_REGISTERS) and not calls(body):
+            self.registers = dict(zip(names, LEAF_REGISTERS))
+            self.frameless = True
+        elif hot:
+            reads = references(body)
+            hottest = sorted((name for name in names if reads[name]), key=lambda name: -reads[name])
+            self.registers = dict(zip(hottest, HOME_REGISTERS))
+        shift = 0
+        for name in names:
+            if name not in self.registers:
+                shift -= 4
+                self.offsets[name] = shift
+        self.size = -shift  # bytes of locals below ebp
+        self.pool = [reg for reg in REGISTERS if reg not in self.registers.values()]
+
+    def location(self, name):
+        """Register or memory operand holding a variable."""
+
+        reg = self.registers.get(name)
+        if reg is not None:
+            return reg
+        return 'DWORD ptr[ebp+' + str(self.offsets[name]) + ']'
+
+    def live_registers(self):
+        """Home registers of the locals assigned so far."""
+
+        return [reg for name, reg in self.registers.items() if name in self.assigned]
+
+    def enter(self):
+        """Instructions of the prologue, up to the arguments."""
+
+        if self.frameless:
+            return ['push ebp'] if 'ebp' in self.registers.values() else []
+        if self.size:
+            return ['push ebp', 'mov ebp, esp', f'sub esp, {self.size}']
+        return ['push ebp', 'mov ebp, esp']
+
+    def leave(self):
+        """Instructions restoring esp and ebp before ret."""
+
+        if self.frameless:
+            return ['pop ebp'] if 'ebp' in self.registers.values() else []
+        return ['mov esp, ebp', 'pop ebp']
+
+
+def is_fastcall(name, arity):
+    """Determines whether a function gets its arguments in registers when
+    fastcall is set; main keeps the convention invoke calls it with."""
+
+    return name != 'main' and arity <= len(FAST_REGISTERS)
+
+
+def calls(nodes):
+    """Determines whether a list of statements calls a function."""
+
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, (CallFunc, TailCall)):
+            return True
+        elif hasattr(node, 'visit'):
+            stack.extend(getattr(node, name) for name in node.__slots__)
+    return False
+
+
+def references(nodes):
+    """Counts the reads of each variable in a list of statements."""
+
+    counts = Counter()
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, Id):
+            counts[node.id] += 1
+        elif hasattr(node, 'visit'):
+            stack.extend(getattr(node, name) for name in node.__slots__)
+    return counts
+
+
+def walk(task):
+    """Runs a visit without recursing into the children.
+
+    A visit method either writes its code right away and returns None, or
+    is a generator that yields the visits of its children where their code
+    goes; those are run from an explicit stack before it is resumed.
+    """
+
+    if task is None:
+        return
+    stack = [task]
+    while stack:
+        try:
+            task = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+        else:
+            if task is not None:
+                stack.append(task)
+
+
+def visit_expression(node, out):
+    """Generates code leaving the value of an expression in eax."""
+
+    if out.regalloc and isinstance(node, Bin_Op):
+        return node.visit_eax(out)
+    return node.visit(out)
+
+
+def sethi_ullman(root):
+    """Returns the need() of root and its operands, keyed by node id."""
+
+    order = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        if isinstance(node, Bin_Op):
+            stack.append(node.left)
+            stack.append(node.right)
+        elif isinstance(node, Unary_Op):
+            stack.append(node.target)
+        elif isinstance(node, Ternary):
+            stack.append(node.condition)
+            stack.append(node.true_con)
+            stack.append(node.false_con)
+    needs = {}
+    for node in reversed(order):  # operands before the nodes using them
+        needs[id(node)] = node.need(needs)
+    return needs
+
+
+def flatten(root):
+    """Encodes an AST as a postfix list of (class, layout) items.
+
+    The layout has one entry per slot: ('node',) or ('list', n) for
+    children, taken from the items before, or ('value', v) for anything
+    else. Unlike the tree itself the list pickles without recursion.
+    """
+
+    items = []
+    stack = [(root, None)]
+    while stack:
+        node, layout = stack.pop()
+        if layout is not None:  # children are done
+            items.append((type(node), layout))
+            continue
+        layout = []
+        children = []
+        for name in node.__slots__:
+            value = getattr(node, name)
+            if hasattr(value, '__slots__'):
+                layout.append(('node',))
+                children.append(value)
+            elif isinstance(value, list) and all(hasattr(n, '__slots__') for n in value):
+                layout.append(('list', len(value)))
+                children.extend(value)
+            else:
+                layout.append(('value', value))
+        stack.append((node, tuple(layout)))
+        stack.extend((child, None) for child in reversed(children))
+    return items
+
+
+def unflatten(items):
+    """Rebuilds the AST encoded by flatten()."""
+
+    values = []
+    for cls, layout in items:
+        count = sum(1 if kind[0] == 'node' else kind[1] for kind in layout if kind[0] != 'value')
+        children = values[len(values) - count:]
+        del values[len(values) - count:]
+        node = cls.__new__(cls)
+        pos = 0
+        for name, kind in zip(cls.__slots__, layout):
+            if kind[0] == 'value':
+                setattr(node, name, kind[1])
+            elif kind[0] == 'node':
+                setattr(node, name, children[pos])
+                pos += 1
+            else:
+                setattr(node, name, children[pos:pos + kind[1]])
+                pos += kind[1]
+        values.append(node)
+    return values[0]
+
+
+def apply_op(out, operation, dst, src):
+    """Emits dst = dst <operation> src for a register dst."""
+
+    if operation == '-':
+        out.emit(f'sub {dst}, {src}')
+    elif operation == '+':
+        out.emit(f'add {dst}, {src}')
+    elif operation == '%':
+        out.emit(f'mov eax, {dst}', 'xor edx, edx', f'div {src}', f'mov {dst}, edx')
+    elif operation == '*':
+        out.emit(f'mov eax, {dst}', f'mul {src}', f'mov {dst}, eax')
+
+
+def constant_operand(node, operation):
+    """Returns the value of a Constant operand of * or % that
+    reduce_op() can lower, None for any other operand."""
+
+    if (operation in ('*', '%') and isinstance(node, Constant)
+            and isinstance(node.value, (int, float))):
+        value = int(node.value)
+        if 0 <= value <= 0xFFFFFFFF and (value or operation == '*'):
+            return value
+    return None
+
+
+def divide_magic(divisor):
+    """Returns (multiplier, shift, add) to divide unsigned 32-bit values.
+
+    x // divisor is (x * multiplier) >> (32 + shift); with add set the
+    multiplier has a 33rd bit that is not included and is added back as
+    x itself, see reduce_op().
+    """
+
+    bits = (divisor - 1).bit_length()
+    for shift in range(bits):
+        multiplier = -(-2 ** (32 + shift) // divisor)
+        if multiplier < 2 ** 32 and multiplier * divisor - 2 ** (32 + shift) <= 2 ** shift:
+            return multiplier, shift, False
+    return -(-2 ** (32 + bits) // divisor) - 2 ** 32, bits, True
+
+
+def reduce_op(out, operation, dst, value):
+    """Emits dst = dst <operation> value for a register dst and a constant
+    value from constant_operand() without mul or div.
+
+    Multiplication becomes shl, lea or imul; modulo becomes and for powers
+    of two and otherwise x - x // value * value, with the quotient taken
+    from a multiplication by the reciprocal. Uses eax and edx, and ebx
+    when dst is eax.
+    """
+
+    signed = value - 2 ** 32 if value >= 2 ** 31 else value  # imul immediate
+    if operation == '*':
+        shift = (value & -value).bit_length() - 1
+        odd = value >> shift if value else 0
+        if value == 0:
+            out.emit(f'xor {dst}, {dst}')
+        elif odd in (3, 5, 9):
+            out.emit(f'lea {dst}, [{dst}+{dst}*{odd - 1}]')
+        elif odd != 1:
+            out.emit(f'imul {dst}, {dst}, {signed}')
+            return
+        if value and shift:
+            out.emit(f'shl {dst}, {shift}')
+        return
+
+    if value == 1:
+        out.emit(f'xor {dst}, {dst}')
+        return
+    if value & (value - 1) == 0:
+        out.emit(f'and {dst}, {value - 1}')
+        return
+    x = dst
+    if dst == 'eax':
+        x = 'ebx'
+        out.emit('mov ebx, eax')
+    else:
+        out.emit(f'mov eax, {x}')
+    multiplier, shift, add = divide_magic(value)
+    out.emit(f'mov edx, {multiplier}', 'mul edx')
+    if add:
+        out.emit(f'mov eax, {x}', 'sub eax, edx', 'shr eax, 1', 'add eax, edx')
+        quotient, shift = 'eax', shift - 1
+    else:
+        quotient = 'edx'
+    if shift:
+        out.emit(f'shr {quotient}, {shift}')
+    out.emit(f'imul {quotient}, {quotient}, {signed}', f'sub {x}, {quotient}')
+    if dst == 'eax':
+        out.emit('mov eax, ebx')
+
+
+def strip_not(node):
+    """Returns (x, negated) for an expression that is x under a chain of
+    nots, negated telling whether their number is odd."""
+
+    negated = False
+    while isinstance(node, Unary_Op) and node.operation == 'not':
+        node, negated = node.target, not negated
+    return node, negated
+
+
+def select_cost(node):
+    """Returns the nodes of an expression that may be evaluated even when
+    its value is not used, None if it calls a function, might divide by
+    zero or has more than BRANCH_COST nodes."""
+
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        if count > BRANCH_COST or isinstance(node, (CallFunc, TailCall)):
+            return None
+        if isinstance(node, Bin_Op):
+            if node.operation == '%' and constant_operand(node.right, '%') is None:
+                return None
+            stack.append(node.left)
+            stack.append(node.right)
+        elif isinstance(node, Unary_Op):
+            stack.append(node.target)
+        elif isinstance(node, Ternary):
+            stack.append(node.condition)
+            stack.append(node.true_con)
+            stack.append(node.false_con)
+    return count
+
+
+def use_cmov(node):
+    """Decides whether a Ternary is lowered without a branch."""
+
+    true, false = select_cost(node.true_con), select_cost(node.false_con)
+    return true is not None and false is not None and true + false <= BRANCH_COST
+
 
 class Module():
+    __slots__ = ('body',)
+
     def __init__(self, body):
         self.body = body
 
@@ -16,19 +383,23 @@ class Module():
         return (other is not None
                 and self.body == other.body)
 
-    def visit(self):
-        mod = ''
+    def visit(self, out):
         for node in self.body:
-            mod += node.visit()
-
-        return mod
+            yield node.visit(out)
 
 
 class FunctionDef():
-    def __init__(self, name, args, body):
+    __slots__ = ('name', 'args', 'body', 'source')
+
+    def __init__(self, name, args, body, source=None):
         self.name = name
         self.args = args
         self.body = body
+        self.source = source  # text the node was parsed from, while unchanged
+
+    def __reduce__(self):
+        # sent to pool workers; deep bodies would overflow the recursive pickler
+        return unflatten, (flatten(self),)
 
     def __eq__(self, other):
         return (other is not None
@@ -36,34 +407,113 @@ class FunctionDef():
                 and self.args == other.args
                 and self.body == other.body)
 
-    def visit(self):
-        global var_map, shift
-        func = f'\n{self.name} PROC\n'
-        func += 'push ebp\nmov ebp, esp\n'
-        scope = {}
-        var_map = var_map.new_child(scope)
-        for num, param in enumerate(self.args):
-            var_map[param] = num*4 + 8
+    def visit(self, out):
+        out.write(f'\n{self.name} PROC\n')
+        fastcall = out.fastcall and is_fastcall(self.name, len(self.args))
+        out.frame = Frame(self.args, self.body, out.hot_locals, fastcall)
+        out.emit(*out.frame.enter())
+        if fastcall:
+            for param, reg in zip(self.args, FAST_REGISTERS):
+                out.emit(f'mov {out.frame.location(param)}, {reg}')
         for node in self.body:
-            func += node.visit()
-        del var_map.maps[0]
-        func += 'mov esp, ebp\npop ebp\n'
-        func += f'\nret\n{self.name} ENDP'
-        shift = -4
-        return func
+            yield node.visit(out)
+        out.emit(*out.frame.leave())
+        out.frame = None
+        out.write(f'\nret\n{self.name} ENDP')
 
 
 class CallFunc:
+    __slots__ = ('name', 'args')
+
+    def __init__(self, id, args):
+        self.name = id
+        self.args = args
+
+    def visit(self, out):
+        saved = out.frame.live_registers()
+        for reg in saved:
+            out.emit(f'push {reg}')
+        for num, val in enumerate(reversed(self.args)):
+            if num:
+                out.write('\n')
+            yield visit_expression(val, out)
+            out.write('\npush eax')
+        if out.fastcall and is_fastcall(self.name, len(self.args)):
+            if self.args:
+                out.write('\n')
+            out.emit(*(f'pop {reg}' for reg in FAST_REGISTERS[:len(self.args)]))
+            out.emit(f'call {self.name}')
+        else:
+            out.write(f'\ncall {self.name}\nadd esp, {4*len(self.args)}\n')
+        for reg in reversed(saved):
+            out.emit(f'pop {reg}')
+
+    def need(self, needs):
+        return 1
+
+    def is_operand(self, operation):
+        return False
+
+    def visit_reg(self, out, regs, needs):
+        live = [reg for reg in out.frame.pool if reg not in regs]
+        for reg in live:
+            out.emit(f'push {reg}')
+        yield self.visit(out)
+        out.emit(f'mov {regs[0]}, eax')
+        for reg in reversed(live):
+            out.emit(f'pop {reg}')
+
+
+class TailCall:
+    """Call of the enclosing function whose value is returned right away.
+
+    Instead of calling, the arguments overwrite the function's own and
+    execution jumps back to its Label with the stack cut back to the
+    locals.
+    """
+
+    __slots__ = ('name', 'args')
+
     def __init__(self, id, args):
         self.name = id
         self.args = args
 
-    def visit(self):
-        return '\n'.join([f'{val.visit()}\npush eax' for val in reversed(self.args)])+f'\ncall {self.name}\nadd esp, ' \
-                                                                              f'{4*len(self.args)}\n'
+    def visit(self, out):
+        for val in reversed(self.args):
+            yield visit_expression(val, out)
+            out.emit('push eax')
+        for param in out.frame.args:
+            out.emit(f'pop {out.frame.location(param)}')
+        if out.frame.size:
+            out.emit(f'lea esp, [ebp-{out.frame.size}]')
+        else:
+            out.emit('mov esp, ebp')
+        out.emit(f'jmp {entry_label(self.name)}')
+
+
+def entry_label(name):
+    return f'{name}_entry'
+
+
+class Label:
+    """Entry of a function for its TailCalls, right after the prologue."""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return (other is not None
+                and self.name == other.name)
+
+    def visit(self, out):
+        out.emit(entry_label(self.name) + ':')
 
 
 class Return():
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -71,14 +521,14 @@ class Return():
         return (other is not None
                 and self.value == other.value)
 
-    def visit(self):
-        ret = self.value.visit()
-
-        ret += 'mov esp, ebp\npop ebp\nret\n'
-        return ret
+    def visit(self, out):
+        yield visit_expression(self.value, out)
+        out.emit(*out.frame.leave(), 'ret')
 
 
 class Bin_Op():
+    __slots__ = ('left', 'right', 'operation')
+
     def __init__(self, left, right, operation):
         self.left = left
         self.right = right
@@ -90,30 +540,122 @@ class Bin_Op():
                 and self.right == other.right
                 and self.operation == other.operation)
 
-    def visit(self):
+    def visit(self, out):
+        if out.strength:
+            value = constant_operand(self.right, self.operation)
+            if value is not None:
+                yield self.left.visit(out)
+                reduce_op(out, self.operation, 'eax', value)
+                return
+            value = constant_operand(self.left, self.operation)
+            if value is not None and self.operation == '*':
+                yield self.right.visit(out)
+                reduce_op(out, self.operation, 'eax', value)
+                return
+        yield self.left.visit(out)
+        out.emit('push eax')
+        yield self.right.visit(out)
+        out.emit('mov ebx, eax', 'pop eax')
         if self.operation == '-':
-            return self.left.visit() + 'push eax\n' + self.right.visit() + 'mov ebx, eax\npop eax\nsub eax, ebx\n'
-        if self.operation == '+':
-            return self.left.visit() + 'push eax\n' + self.right.visit() + 'mov ebx, eax\npop eax\nadd eax, ebx\n'
-        if self.operation == '%':
-            return self.left.visit() + 'push eax\n' + self.right.visit() + 'mov ebx, eax\npop eax\nxor edx, edx\n' \
-                                                                           'div ebx\nmov eax, edx\n'
-        if self.operation == '*':
-            return self.left.visit() + 'push eax\n' + self.right.visit() + 'mov ebx, eax\npop eax\nxor edx, edx\n' \
-                                                                           'mul ebx\n'
+            out.emit('sub eax, ebx')
+        elif self.operation == '+':
+            out.emit('add eax, ebx')
+        elif self.operation == '%':
+            out.emit('xor edx, edx', 'div ebx', 'mov eax, edx')
+        elif self.operation == '*':
+            out.emit('xor edx, edx', 'mul ebx')
+
+    def need(self, needs):
+        """Sethi-Ullman number: registers needed to evaluate without spilling.
+
+        needs holds the numbers of the operands, see sethi_ullman().
+        """
+
+        left = needs[id(self.left)]
+        right = 0 if self.right.is_operand(self.operation) else needs[id(self.right)]
+        return max(left, right) if left != right else left + 1
+
+    def is_operand(self, operation):
+        return False
+
+    def visit_eax(self, out):
+        """Evaluates in registers, then moves the value to eax."""
+
+        regs = out.frame.pool
+        yield self.visit_reg(out, regs, sethi_ullman(self))
+        out.emit(f'mov eax, {regs[0]}')
+
+    def visit_reg(self, out, regs, needs):
+        """Evaluates into regs[0], using only the registers in regs."""
+
+        if out.strength:
+            value = constant_operand(self.right, self.operation)
+            if value is not None:
+                yield self.left.visit_reg(out, regs, needs)
+                reduce_op(out, self.operation, regs[0], value)
+                return
+            value = constant_operand(self.left, self.operation)
+            if value is not None and self.operation == '*':
+                yield self.right.visit_reg(out, regs, needs)
+                reduce_op(out, self.operation, regs[0], value)
+                return
+        if self.right.is_operand(self.operation):
+            yield self.left.visit_reg(out, regs, needs)
+            apply_op(out, self.operation, regs[0], self.right.operand(out))
+            return
+        left, right = needs[id(self.left)], needs[id(self.right)]
+        if len(regs) > 1 and right <= left and right < len(regs):
+            yield self.left.visit_reg(out, regs, needs)
+            yield self.right.visit_reg(out, regs[1:], needs)
+        elif len(regs) > 1 and left < len(regs) and right > left:
+            yield self.right.visit_reg(out, [regs[1], regs[0]] + regs[2:], needs)
+            yield self.left.visit_reg(out, [regs[0]] + regs[2:], needs)
+        else:
+            yield self.right.visit_reg(out, regs, needs)
+            out.emit(f'push {regs[0]}')
+            yield self.left.visit_reg(out, regs, needs)
+            apply_op(out, self.operation, regs[0], 'DWORD ptr[esp]')
+            out.emit('add esp, 4')
+            return
+        apply_op(out, self.operation, regs[0], regs[1])
 
 
 class Unary_Op:
+    __slots__ = ('target', 'operation')
+
     def __init__(self, target, operation):
         self.target = target
         self.operation = operation
 
-    def visit(self):
-        if self.operation == 'not':
-            return self.target.visit() + '.if eax == 0\n mov eax, 1\n.else\nmov eax, 0\n.endif\n'
+    def visit(self, out):
+        if self.operation == 'not' and out.branchless:
+            target, negated = strip_not(self)
+            yield visit_expression(target, out)
+            out.emit('test eax, eax', 'sete al' if negated else 'setne al', 'movzx eax, al')
+        elif self.operation == 'not':
+            yield visit_expression(self.target, out)
+            out.emit('.if eax == 0', ' mov eax, 1', '.else', 'mov eax, 0', '.endif')
+
+    def need(self, needs):
+        return needs[id(self.target)]
+
+    def is_operand(self, operation):
+        return False
+
+    def visit_reg(self, out, regs, needs):
+        if self.operation == 'not' and out.branchless:
+            target, negated = strip_not(self)
+            yield target.visit_reg(out, regs, needs)
+            out.emit(f'test {regs[0]}, {regs[0]}', 'sete al' if negated else 'setne al',
+                     f'movzx {regs[0]}, al')
+        elif self.operation == 'not':
+            yield self.target.visit_reg(out, regs, needs)
+            out.emit(f'.if {regs[0]} == 0', f'mov {regs[0]}, 1', '.else', f'mov {regs[0]}, 0', '.endif')
 
 
 class Ternary:
+    __slots__ = ('true_con', 'false_con', 'condition')
+
     def __init__(self, true_con, false_con, condition):
         self.true_con = true_con
         self.false_con = false_con
@@ -125,11 +667,60 @@ class Ternary:
                 and self.false_con == other.false_con
                 and self.condition == other.condition)
 
-    def visit(self):
-        return self.condition.visit()+'.if eax == 0\n'+self.false_con.visit()+'.else\n'+self.true_con.visit()+'.endif\n'
+    def visit(self, out):
+        if not out.branchless:
+            yield visit_expression(self.condition, out)
+            out.emit('.if eax == 0')
+            yield visit_expression(self.false_con, out)
+            out.emit('.else')
+            yield visit_expression(self.true_con, out)
+            out.emit('.endif')
+            return
+        condition, negated = strip_not(self.condition)
+        if use_cmov(self):
+            yield visit_expression(self.true_con, out)
+            out.emit('push eax')
+            yield visit_expression(self.false_con, out)
+            out.emit('push eax')
+            yield visit_expression(condition, out)
+            out.emit('test eax, eax', 'pop eax', 'pop ebx',  # pop keeps the flags
+                     'cmovz eax, ebx' if negated else 'cmovnz eax, ebx')
+            return
+        yield visit_expression(condition, out)
+        out.emit('.if eax == 0')
+        yield visit_expression(self.true_con if negated else self.false_con, out)
+        out.emit('.else')
+        yield visit_expression(self.false_con if negated else self.true_con, out)
+        out.emit('.endif')
+
+    def need(self, needs):
+        return max(needs[id(self.condition)], needs[id(self.true_con)], needs[id(self.false_con)])
+
+    def is_operand(self, operation):
+        return False
+
+    def visit_reg(self, out, regs, needs):
+        condition, negated = self.condition, False
+        if out.branchless:
+            condition, negated = strip_not(condition)
+            if len(regs) > 2 and use_cmov(self):
+                yield self.false_con.visit_reg(out, regs, needs)
+                yield self.true_con.visit_reg(out, regs[1:], needs)
+                yield condition.visit_reg(out, regs[2:], needs)
+                out.emit(f'test {regs[2]}, {regs[2]}',
+                         f'{"cmovz" if negated else "cmovnz"} {regs[0]}, {regs[1]}')
+                return
+        yield condition.visit_reg(out, regs, needs)
+        out.emit(f'.if {regs[0]} == 0')
+        yield (self.true_con if negated else self.false_con).visit_reg(out, regs, needs)
+        out.emit('.else')
+        yield (self.false_con if negated else self.true_con).visit_reg(out, regs, needs)
+        out.emit('.endif')
 
 
 class Assign:
+    __slots__ = ('id', 'expression')
+
     def __init__(self, id: str, expresion):
         self.id = id
         self.expression = expresion
@@ -139,17 +730,15 @@ class Assign:
                 and self.id == other.id
                 and self.expression == other.expression)
 
-    def visit(self):
-        global shift
-        if var_map.get(self.id):
-            shift_off = var_map.get(self.id)
-            return self.expression.visit() + 'mov DWORD ptr[ebp+' + str(shift_off) + '], eax\n'
-        var_map[self.id] = shift
-        shift -= 4
-        return self.expression.visit() + 'push eax\n'
+    def visit(self, out):
+        yield visit_expression(self.expression, out)
+        out.frame.assigned.add(self.id)
+        out.emit(f'mov {out.frame.location(self.id)}, eax')
 
 
 class Id:
+    __slots__ = ('id',)
+
     def __init__(self, id):
         self.id = id
 
@@ -157,13 +746,29 @@ class Id:
         return (other is not None
                 and self.id == other.id)
 
-    def visit(self):
-        if var_map.get(self.id):
-            shift_off = var_map.get(self.id)
-            return 'mov eax, DWORD ptr[ebp+' + str(shift_off) + ']\n'
+    def visit(self, out):
+        out.emit('mov eax, ' + self.operand(out))
+
+    def need(self, needs):
+        return 1
+
+    def is_operand(self, operation):
+        return True
+
+    def operand(self, out):
+        """Memory operand holding the variable."""
+
+        if self.id not in out.frame.assigned:
+            raise SyntaxError(f'Unknown variable, {self.id}')
+        return out.frame.location(self.id)
+
+    def visit_reg(self, out, regs, needs):
+        out.emit(f'mov {regs[0]}, ' + self.operand(out))
 
 
 class Constant:
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -171,7 +776,24 @@ class Constant:
         return (other is not None
                 and self.value == other.value)
 
-    def visit(self):
+    def visit(self, out):
+        out.emit('mov eax, ' + self.literal())
+
+    def literal(self):
         if type(self.value) == float:
-            return 'mov eax, ' + str(int(self.value)) + '\n'
-        return 'mov eax, ' + str(self.value) + '\n'
+            return str(int(self.value))
+        return str(self.value)
+
+    def need(self, needs):
+        return 1
+
+    def is_operand(self, operation):
+        """Immediates are only taken by add and sub."""
+
+        return operation in ('+', '-')
+
+    def operand(self, out):
+        return self.literal()
+
+    def visit_reg(self, out, regs, needs):
+        out.emit(f'mov {regs[0]}, ' + self.literal())